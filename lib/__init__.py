@@ -51,6 +51,12 @@ _folders_schema_ = {
             "action": "search_channels"
         }
     },
+    "favorites": {
+        "": {
+            "id": 30017,
+            "plot": 30018
+        }
+    },
     "browse": {
         "": {
             "id": 30001
@@ -66,6 +72,7 @@ _folders_schema_ = {
 
 _folders_defaults_ = (
     {"type": "channels", "style": "topStreams"},
+    {"type": "favorites"},
     {"type": "browse"},
     {"type": "search"}
 )
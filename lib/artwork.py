@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+
+from __future__ import absolute_import, division, unicode_literals
+
+
+import re
+
+from errno import EEXIST
+from hashlib import sha1
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+from os import close, listdir, makedirs, remove, stat, utime
+from os.path import exists, join, splitext
+from tempfile import mkstemp
+from threading import Lock
+
+try:
+    from os import replace
+except ImportError: # python 2, rename overwrites on posix only
+    from os import rename as replace
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from six import iteritems
+from six.moves.urllib.parse import urlparse
+from kodi_six import xbmc
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from .utils import get_profile_path, settings, debug, warn
+
+
+# ------------------------------------------------------------------------------
+# renditions
+# ------------------------------------------------------------------------------
+
+# channel thumbnails come in two sizes
+def _thumbs_(match, width):
+    return "{}.{}.jpg".format(match.group(1), "small" if width <= 480 else "big")
+
+
+# (pattern, func(match, width)) for the hosts that can resize for us
+_renditions_ = (
+    (re.compile(
+        r"^(https?://thumbs\.mixer\.com/channel/\d+)\.(?:small|big)\.jpg$"),
+     _thumbs_),
+)
+
+
+def _rendition_(url, width):
+    for pattern, func in _renditions_:
+        match = pattern.match(url)
+        if match:
+            return func(match, width), True
+    return url, False
+
+
+# ------------------------------------------------------------------------------
+# artwork
+# ------------------------------------------------------------------------------
+
+class Artwork(object):
+
+    _extensions_ = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+    _timeout_ = 10
+
+    # width of each art role, relative to the screen width
+    _roles_ = {"fanart": 1.0, "thumb": 0.33, "poster": 0.25}
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.pending = {}
+        self.pool = None
+        self.session = None
+        self.size = None # bytes on disk, see _grow_()
+        self.screen_width = None
+
+    @property
+    def enabled(self):
+        return settings.artwork_cache
+
+    @property
+    def max_size(self):
+        return settings.artwork_cache_size * 1024 * 1024
+
+    def _pool_(self):
+        if self.pool is None:
+            # as many connections as there are download threads
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=settings.pool_size)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            self.pool = ThreadPool(settings.pool_size)
+        return self.pool
+
+    def _filename_(self, url, width=0):
+        ext = splitext(urlparse(url).path)[1].lower()
+        if ext not in self._extensions_:
+            ext = ".jpg"
+        name = sha1(url.encode("utf-8")).hexdigest()
+        if width:
+            name = "-".join((name, str(width)))
+        return join(self.path, "".join((name, ext)))
+
+    def _width_(self, role):
+        if self.screen_width is None:
+            try:
+                self.screen_width = int(
+                    xbmc.getInfoLabel("System.ScreenWidth")) or 1920
+            except ValueError:
+                self.screen_width = 1920
+        # round up to a multiple of 64 to limit the number of variants
+        width = int(self.screen_width * self._roles_.get(role, 1.0))
+        return -(-width // 64) * 64
+
+    # returns (url, filename, width) where width is only set if the image has
+    # to be downscaled locally
+    def _resolve_(self, role, url):
+        width = self._width_(role)
+        url, resized = _rendition_(url, width)
+        if resized or Image is None:
+            width = 0
+        return url, self._filename_(url, width), width
+
+    # disk usage ---------------------------------------------------------------
+
+    def _files_(self):
+        files = []
+        for name in listdir(self.path):
+            if not name.endswith(".tmp"):
+                path = join(self.path, name)
+                st = stat(path)
+                files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def _trim_(self):
+        target = self.max_size * 0.9
+        # least recently used first, see get()
+        for mtime, size, path in sorted(self._files_()):
+            if self.size <= target:
+                break
+            try:
+                remove(path)
+            except OSError:
+                continue
+            self.size -= size
+        debug("artwork cache trimmed to {} bytes".format(self.size))
+
+    def _grow_(self, size):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(f[1] for f in self._files_())
+            else:
+                self.size += size
+            if self.size > self.max_size:
+                self._trim_()
+
+    # fetch --------------------------------------------------------------------
+
+    def _downscale_(self, content, width, temp):
+        image = Image.open(BytesIO(content))
+        if image.size[0] <= width:
+            return False
+        _format = image.format
+        height = int(image.size[1] * width / image.size[0])
+        # LANCZOS is ANTIALIAS renamed (and the only name in recent Pillow)
+        resample = getattr(Image, "LANCZOS", None) or Image.ANTIALIAS
+        image = image.resize((width, height), resample)
+        if _format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(temp, _format)
+        return True
+
+    def _download_(self, url, filename, width=0):
+        try:
+            response = self.session.get(url, timeout=self._timeout_)
+            response.raise_for_status()
+            # unique, other invocations may be fetching the same file
+            fd, temp = mkstemp(suffix=".tmp", dir=self.path)
+            close(fd)
+            try:
+                if not (width and
+                        self._downscale_(response.content, width, temp)):
+                    with open(temp, "wb") as f:
+                        f.write(response.content)
+                replace(temp, filename)
+            except Exception:
+                remove(temp)
+                raise
+            self._grow_(stat(filename).st_size)
+        except Exception as error:
+            warn("failed to fetch artwork '{}': {}".format(url, error))
+        finally:
+            with self.lock:
+                self.pending.pop(filename, None)
+
+    def fetch(self, art):
+        try:
+            makedirs(self.path)
+        except OSError as error:
+            if error.errno != EEXIST:
+                raise
+        results = []
+        for role, url in set(art):
+            if url:
+                url, filename, width = self._resolve_(role, url)
+                with self.lock:
+                    result = self.pending.get(filename)
+                    if result is None:
+                        if exists(filename):
+                            continue
+                        result = self._pool_().apply_async(
+                            self._download_, (url, filename, width))
+                        self.pending[filename] = result
+                results.append(result)
+        return results
+
+    # downloads happen in the background, listings use the remote urls until
+    # the files are cached (see get())
+    def prefetch(self, items):
+        if self.enabled:
+            self.fetch(art for item in items for art in iteritems(item.art()))
+
+    def _prefetch_(self, func):
+        try:
+            self.prefetch(func())
+        except Exception as error:
+            warn("failed to prefetch artwork: {}".format(error))
+
+    # func is called from a worker thread, it should return the next page
+    def prefetch_later(self, func):
+        if self.enabled:
+            self._pool_().apply_async(self._prefetch_, (func,))
+
+    # --------------------------------------------------------------------------
+
+    # local path if cached, the (resized when possible) remote url otherwise
+    def get(self, role, url):
+        if url:
+            url, filename, width = self._resolve_(role, url)
+            if self.enabled and exists(filename):
+                try:
+                    utime(filename, None)
+                except OSError:
+                    pass
+                return filename
+        return url
+
+    def paths(self, art):
+        return {role: self.get(role, url) for role, url in iteritems(art)}
+
+
+artwork = Artwork(get_profile_path("artwork"))
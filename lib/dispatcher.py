@@ -5,16 +5,27 @@ from __future__ import absolute_import, division, unicode_literals
 
 
 from six import wraps
-from kodi_six import xbmc, xbmcplugin
+from kodi_six import xbmc, xbmcgui, xbmcplugin
 from inputstreamhelper import Helper
 
-from .utils import parse_query, get_setting, get_subfolders, more_item
-from .utils import localized_string, search_dialog
+from .utils import parse_query, build_url, get_subfolders, more_item, chunked
+from .utils import SettingsMonitor, settings
+from .utils import localized_string, get_language, search_dialog, notify
+from .utils import select_dialog
+from .utils import debug
+from .artwork import artwork
+from .favorites import favorites
 from .mixer.api import service
-from .mixer.objects import Folders
+from .mixer.objects import Folders, _filters_
 
 
-def action(category=0):
+# applied locally to the listing (see MixerItems.select), never sent to the api
+_local_args_ = ("sort",) + tuple(_filters_)
+
+
+# budget: seconds the requests of the action have to complete in (0: no limit)
+# hedge: fire a duplicate of slow GETs, the first response wins
+def action(category=0, budget=0, hedge=False):
     def decorator(func):
         func.__action__ = True
         @wraps(func)
@@ -22,24 +33,35 @@ def action(category=0):
             try:
                 self.category = category
                 self.action = func.__name__
-                success = func(self, **kwargs)
+                self.filters = {name: kwargs.pop(name)
+                                for name in _local_args_ if name in kwargs}
+                with service.session.budget(budget, hedge):
+                    success = func(self, **kwargs)
             except Exception:
                 success = False
                 raise
             finally:
                 self.endDirectory(success)
-                del self.action, self.category
+                del self.action, self.category, self.filters
         return wrapper
     return decorator
 
 
+# actions that do not build a directory (i.e. called via RunPlugin)
+def command(func):
+    func.__action__ = True
+    return func
+
+
 class Dispatcher(object):
 
+    _chunk_size_ = 25
+
     def __init__(self, url, handle):
         self.url = url
         self.handle = handle
-        self.limit = get_setting("items_per_page", int)
-        self.language = xbmc.getLanguage(xbmc.ISO_639_1)
+        self.limit = settings.items_per_page
+        self.language = get_language().split("-")[0]
 
 
     # utils --------------------------------------------------------------------
@@ -59,15 +81,25 @@ class Dispatcher(object):
         return True
 
     def addItems(self, items, *args, **kwargs):
-        if not xbmcplugin.addDirectoryItems(
-            self.handle, [item.asItem()
-                          for item in items.items(self.url, *args) if item]):
-            raise
+        # hand items to kodi as they are built, totalItems lets the skin
+        # layout the whole directory early
+        total = items.total
+        for chunk in chunked(items.select(**self.filters), self._chunk_size_):
+            if not xbmcplugin.addDirectoryItems(
+                self.handle, [listitem.asItem() for listitem in
+                              (item.item(self.url, *args) for item in chunk)
+                              if listitem], total):
+                raise
         if items.more:
+            if items.next:
+                artwork.prefetch_later(items.next)
             kwargs["page"] = int(kwargs.get("page", 0)) + 1
+            kwargs.update(self.filters)
             self.addItem(more_item(self.url, action=self.action, **kwargs))
         if items.content:
             xbmcplugin.setContent(self.handle, items.content)
+        for method in items.sortMethods:
+            xbmcplugin.addSortMethod(self.handle, method)
         if items.category:
             self.setCategory(items.category)
         return True
@@ -84,45 +116,95 @@ class Dispatcher(object):
 
     # actions ------------------------------------------------------------------
 
-    @action()
+    @action(budget=10, hedge=True)
     def play_stream(self, **kwargs):
-        quality = get_setting("stream_quality", int)
+        quality = settings.stream_quality
         item = service.stream_item(kwargs.pop("id"), quality, **kwargs)
         return self.play(item, quality) if item else False
 
     @action()
     def play_vod(self, **kwargs):
-        quality = get_setting("vod_quality", int)
+        quality = settings.vod_quality
         item = service.vod_item(kwargs.pop("id"), quality, **kwargs)
         return self.play(item, quality) if item else False
 
-    @action()
+    @action(budget=10, hedge=True)
     def home(self, **kwargs):
         return self.addItems(service.home(**kwargs))
 
-    @action(30007)
+    @action(30007, budget=10, hedge=True)
     def featured(self, **kwargs):
         return self.addItems(
             service.featured(language=self.language, **kwargs), "play_stream")
 
-    @action(30009)
+    @action(30009, budget=10, hedge=True)
     def spotlight(self, **kwargs):
         return self.addItems(service.spotlight(**kwargs), "browse_channel")
 
-    @action(30011)
+    @action(30011, budget=10, hedge=True)
     def top_games(self, **kwargs):
         return self.addItems(service.top_games(**kwargs), "browse_game")
 
-    @action(30013)
+    @action(30013, budget=10, hedge=True)
     def up_and_coming(self, **kwargs):
         return self.addItems(service.up_and_coming(**kwargs), "play_stream")
 
-    @action(30015)
+    @action(30015, budget=10, hedge=True)
     def top_streams(self, **kwargs):
         return self.addItems(
             service.top_streams(**kwargs), "play_stream", **kwargs)
 
 
+    # favorites ----------------------------------------------------------------
+
+    @action(30017)
+    def favorites(self, **kwargs):
+        return self.addItems(service.favorites(favorites), "browse_channel")
+
+    @command
+    def add_favorite(self, **kwargs):
+        if favorites.add(kwargs["id"]):
+            notify(30062, icon=xbmcgui.NOTIFICATION_INFO)
+
+    @command
+    def remove_favorite(self, **kwargs):
+        if favorites.remove(kwargs["id"]):
+            notify(30063, icon=xbmcgui.NOTIFICATION_INFO)
+            xbmc.executebuiltin("Container.Refresh")
+
+
+    # sort/filter --------------------------------------------------------------
+
+    # kwargs are the values of the item the context menu was opened on, the
+    # listing is then reloaded (from the response cache) with the new args
+    @command
+    def sort_filter(self, **kwargs):
+        choices = [(30070, {"sort": "viewers"}),
+                   (30071, {"sort": "followers"}),
+                   (30072, {"sort": "name"}),
+                   (30073, {"sort": "language"}),
+                   (30074, {"online": "true"})]
+        choices.extend((label, {name: kwargs[name]})
+                       for label, name in ((30075, "languageId"),
+                                           (30076, "typeId"),
+                                           (30077, "audience"))
+                       if kwargs.get(name))
+        choices.append((30078, None))
+        index = select_dialog(30065, [label for label, _ in choices])
+        if index >= 0:
+            path = xbmc.getInfoLabel("Container.FolderPath")
+            path, _, query = path.partition("?")
+            args = parse_query(query)
+            update = choices[index][1]
+            if update is None:
+                for name in _local_args_:
+                    args.pop(name, None)
+            else:
+                args.update(update)
+            xbmc.executebuiltin(
+                "Container.Update({},replace)".format(build_url(path, **args)))
+
+
     # browse -------------------------------------------------------------------
 
     @action(30001)
@@ -189,6 +271,19 @@ class Dispatcher(object):
         return action(**kwargs)
 
 
+# keeps settings up to date for as long as the invoker is reused
+monitor = SettingsMonitor()
+
+
 def dispatch(url, handle, query, *args):
-    Dispatcher(url, int(handle)).dispatch(**parse_query(query))
+    settings.refresh()
+    service.game_cache.resize(settings.game_cache_size)
+    service.response_cache.resize(settings.response_cache_size)
+    service.search_cache.resize(settings.search_cache_size)
+    try:
+        Dispatcher(url, int(handle)).dispatch(**parse_query(query))
+    finally:
+        debug("transport: {}".format(service.session.stats))
+        for name, cache in service.caches():
+            debug("{} cache: {}".format(name, cache.stats))
 
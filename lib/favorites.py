@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+
+from __future__ import absolute_import, division, unicode_literals
+
+
+import json
+
+from errno import EEXIST
+from os import fdopen, makedirs, remove
+from os.path import dirname, exists, getmtime
+from tempfile import mkstemp
+
+try:
+    from os import replace
+except ImportError: # python 2, rename overwrites on posix only
+    from os import rename as replace
+
+from .utils import get_profile_path
+
+
+class Favorites(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.__ids__ = []
+
+    # the file is shared with other invocations (and the service), reload it
+    # whenever it changed on disk
+    def _load_(self):
+        mtime = getmtime(self.path) if exists(self.path) else None
+        if mtime != self.mtime:
+            if mtime is None:
+                self.__ids__ = []
+            else:
+                try:
+                    with open(self.path, "r") as f:
+                        self.__ids__ = [int(id) for id in json.load(f)]
+                except ValueError: # keep the previous ids, retry next time
+                    return self.__ids__
+            self.mtime = mtime
+        return self.__ids__
+
+    # readers never see a partial file: write a temp file next to it and
+    # move it over the previous one
+    def _save_(self, ids):
+        path = dirname(self.path)
+        try:
+            makedirs(path)
+        except OSError as error:
+            if error.errno != EEXIST:
+                raise
+        fd, temp = mkstemp(suffix=".tmp", dir=path)
+        try:
+            with fdopen(fd, "w") as f:
+                json.dump(ids, f)
+            replace(temp, self.path)
+        except Exception:
+            remove(temp)
+            raise
+        self.__ids__ = ids
+        self.mtime = getmtime(self.path)
+
+    def __contains__(self, id):
+        return int(id) in self._load_()
+
+    def __iter__(self):
+        return iter(self._load_())
+
+    def __len__(self):
+        return len(self._load_())
+
+    def ids(self):
+        return list(self._load_())
+
+    def add(self, id):
+        ids = self._load_()
+        if int(id) not in ids:
+            self._save_(ids + [int(id)])
+            return True
+        return False
+
+    def remove(self, id):
+        ids = self._load_()
+        if int(id) in ids:
+            self._save_([_id for _id in ids if _id != int(id)])
+            return True
+        return False
+
+
+favorites = Favorites(get_profile_path("favorites.json"))
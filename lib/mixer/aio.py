@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+
+# python 3 only (async def is a SyntaxError on python 2), see api.AsyncQuery
+
+
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+# runs MixerService.query calls concurrently on an event loop, the requests
+# themselves still go through the (pooled, hedged) MixerSession
+class AsyncQuery(object):
+
+    def __init__(self, service, workers=4):
+        self.service = service
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _query_(self, deadline, hedge, url, kwargs):
+        # the latency budget of the caller applies to its queries
+        with self.service.session.apply(deadline, hedge):
+            return self.service.query(url, **kwargs)
+
+    async def query(self, url, **kwargs):
+        policy = self.service.session.policy
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor,
+            partial(self._query_, policy.deadline, policy.hedge, url, kwargs))
+
+    async def _gather_(self, queries):
+        return await asyncio.gather(
+            *(self.query(url, **kwargs) for url, kwargs in queries))
+
+    # queries: sequence of (url, kwargs), results come in the same order
+    def gather(self, queries):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._gather_(queries))
+        finally:
+            loop.close()
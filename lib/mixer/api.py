@@ -4,27 +4,171 @@
 from __future__ import absolute_import, division, unicode_literals
 
 
+import json
+
 import requests
 import m3u8
 
+from contextlib import contextmanager
+from itertools import chain
+from threading import Lock, Thread
+from time import time
+
+from six import iteritems
+from six.moves.queue import Empty, Queue
 from six.moves.urllib.parse import urljoin
 
 from . import objects
-from ..utils import StreamQuality, notify, debug
+from .cache import ResponseCache
+from .index import Index, SearchCache, SearchResults
+from .store import Store
+from .transport import MixerAdapter, LatencyTracker, Policy, endpoint
+from .transport import iter_response
+from ..utils import StreamQuality, get_profile_path, settings, notify, debug
+from ..utils import warn
+
+try:
+    from .aio import AsyncQuery
+except (ImportError, SyntaxError): # python 2, or no asyncio
+    AsyncQuery = None
 
 
 class MixerSession(requests.Session):
 
-    def __init__(self, headers=None):
+    _hedge_delay_ = 1.0 # until we have enough samples for an endpoint
+    _hedge_min_delay_ = 0.1
+
+    def __init__(self, headers=None, pool_size=10):
         super(MixerSession, self).__init__()
         if headers:
             self.headers.update(headers)
-
-    def request(self, *args, **kwargs):
-        response = super(MixerSession, self).request(*args, **kwargs)
+        self.adapter = MixerAdapter(pool_size=pool_size)
+        self.mount("https://", self.adapter)
+        self.mount("http://", self.adapter)
+        self.latencies = LatencyTracker()
+        self.policy = Policy()
+
+    @property
+    def stats(self):
+        return self.adapter.stats
+
+    @contextmanager
+    def apply(self, deadline=None, hedge=False):
+        self.policy.deadline = deadline
+        self.policy.hedge = hedge
+        try:
+            yield
+        finally:
+            self.policy.deadline = None
+            self.policy.hedge = False
+
+    def budget(self, budget=0, hedge=False):
+        # every request made within has to complete before the deadline,
+        # idempotent ones (GET) are hedged if hedge is True
+        return self.apply((time() + budget) if budget else None, hedge)
+
+    def _request_(self, method, url, **kwargs):
+        start = time()
+        response = super(MixerSession, self).request(method, url, **kwargs)
+        self.latencies.add(endpoint(url), time() - start)
         response.raise_for_status()
         return response
 
+    def _hedged_(self, method, url, **kwargs):
+        # fire a second attempt if the first one is slower than the p95 of
+        # this endpoint, the first successful response wins
+        results = Queue()
+        lock = Lock()
+        done = []
+        def attempt(hedge):
+            response = failure = None
+            try:
+                response = self._request_(method, url, **kwargs)
+            except Exception as error:
+                failure = error
+            with lock:
+                if not done:
+                    results.put((response, failure, hedge))
+                    return
+            if response is not None: # lost the race
+                response.close()
+        def finish():
+            # no attempt can put after this, close what is left in the queue
+            with lock:
+                done.append(True)
+            while not results.empty():
+                response = results.get()[0]
+                if response is not None:
+                    response.close()
+        def start(hedge=False):
+            thread = Thread(target=attempt, args=(hedge,))
+            thread.daemon = True
+            thread.start()
+        delay = max(self._hedge_min_delay_,
+                    self.latencies.percentile(
+                        endpoint(url), 95, self._hedge_delay_))
+        timeout = kwargs.get("timeout")
+        deadline = (time() + timeout) if timeout else None
+        attempts, errors = 1, []
+        start()
+        while True:
+            wait = max(0, deadline - time()) if deadline else None
+            if attempts == 1 and (wait is None or delay < wait):
+                wait = delay
+            try:
+                response, error, hedge = results.get(timeout=wait)
+            except Empty:
+                if attempts == 1 and (deadline is None or deadline > time()):
+                    self.stats.hedge()
+                    start(True)
+                    attempts += 1
+                    continue
+                finish()
+                raise requests.Timeout(
+                    "Latency budget exceeded: {}".format(url))
+            if error is None:
+                finish()
+                if hedge:
+                    self.stats.hedge(won=True)
+                return response
+            errors.append(error)
+            if len(errors) >= attempts:
+                raise errors[0]
+
+    def request(self, method, url, **kwargs):
+        if self.policy.deadline is not None:
+            timeout = self.policy.deadline - time()
+            if timeout <= 0:
+                raise requests.Timeout(
+                    "Latency budget exceeded: {}".format(url))
+            kwargs.setdefault("timeout", timeout)
+        if (self.policy.hedge and settings.hedge_requests and
+            method.upper() == "GET"):
+            return self._hedged_(method, url, **kwargs)
+        return self._request_(method, url, **kwargs)
+
+
+def _observed_(results, callback, size=25):
+    # callback is called with a sequence of results, in batches when streaming
+    if isinstance(results, list):
+        callback(results)
+        return results
+    def observe():
+        batch = []
+        for result in results:
+            batch.append(result)
+            if len(batch) >= size:
+                callback(batch)
+                batch = []
+            yield result
+        if batch:
+            callback(batch)
+    return observe()
+
+
+def _viewers_(result):
+    return result["viewersCurrent"]
+
 
 class MixerService(object):
 
@@ -46,12 +190,86 @@ class MixerService(object):
 
     _default_order_ = "viewersCurrent:DESC"
 
-    def __init__(self):
-        self.session = MixerSession(headers=self._headers_)
-        self.game_cache = objects.Cache(self._games_())
+    # fields used by objects.ExtendedChannel/objects.Stream, and for sorting
+    # (see objects._sort_keys_)
+    _channel_fields_ = ("id", "token", "name", "online", "viewersCurrent",
+                        "numFollowers", "audience", "languageId", "bannerUrl")
+    _channel_objects_ = ("user", "type", "thumbnail")
+
+    # maximum number of ids per 'where=id:in:...' query (also the api max limit)
+    _chunk_size_ = 100
 
-    def query(self, url, **kwargs):
-        return self.session.get(urljoin(self._url_, url), params=kwargs).json()
+    # how many pages of local matches a search starts with
+    _local_pages_ = 3
+
+    # how long the stored game types are good for a warm start
+    _games_ttl_ = 3600
+
+    def __init__(self):
+        self.session = MixerSession(
+            headers=self._headers_, pool_size=settings.pool_size)
+        self.store = Store(get_profile_path("mixer.db"))
+        self.channel_index = Index(self.store, "channels", "token")
+        self.game_index = Index(self.store, "games", "name")
+        self.search_cache = SearchCache(size=settings.search_cache_size)
+        self.response_cache = ResponseCache(size=settings.response_cache_size)
+        self.aio = AsyncQuery(self, settings.pool_size) if AsyncQuery else None
+        # no network here, this runs at import (also in the service, that
+        # may start before the network is up), see _warm_games_()
+        self.game_cache = objects.Cache(
+            objects.Games(self.store.games(self._games_ttl_)),
+            size=settings.game_cache_size, ttl=self._games_ttl_)
+        self.games_warm = len(self.game_cache) > 0
+
+    def caches(self):
+        return (("response", self.response_cache),
+                ("search", self.search_cache),
+                ("game", self.game_cache))
+
+    # responses are cached in memory, then in the store ------------------------
+
+    def _cached_(self, key):
+        results = self.response_cache.get(key, settings.cache_ttl)
+        if results is None:
+            results = self.store.response(key, settings.cache_ttl)
+            if results is not None:
+                self.response_cache.set(key, results)
+        return results
+
+    def _cache_(self, key, results):
+        self.response_cache.set(key, results)
+        self.store.update_response(key, results, settings.cache_ttl)
+
+    def _recorded_(self, key, results):
+        recorded = []
+        for result in results:
+            recorded.append(result)
+            yield result
+        self._cache_(key, recorded)
+
+    def query(self, url, stream=False, cache=False, **kwargs):
+        cache = cache and settings.cache_ttl
+        if cache:
+            key = json.dumps([url, sorted(iteritems(kwargs))])
+            results = self._cached_(key)
+            if results is not None:
+                return results
+        response = self.session.get(
+            urljoin(self._url_, url), params=kwargs, stream=stream)
+        if stream: # list endpoints only, see transport.iter_array
+            results = iter_response(response)
+            return self._recorded_(key, results) if cache else results
+        results = response.json()
+        if cache:
+            self._cache_(key, results)
+        return results
+
+    # queries: sequence of (url, kwargs), results come in the same order
+    def query_all(self, queries):
+        queries = list(queries)
+        if self.aio and len(queries) > 1:
+            return self.aio.gather(queries)
+        return [self.query(url, **kwargs) for url, kwargs in queries]
 
     # --------------------------------------------------------------------------
 
@@ -89,8 +307,13 @@ class MixerService(object):
     def _where_id_in_(self, ids):
         return ":".join(("id", "in", ";".join(map(str, ids))))
 
+    def _chunks_(self, ids):
+        ids = list(ids)
+        for i in range(0, len(ids), self._chunk_size_):
+            yield ids[i:i + self._chunk_size_]
+
     def _get_home_(self, **kwargs):
-        return self.query(self._urls_["home"], **kwargs)["rows"]
+        return self.query(self._urls_["home"], cache=True, **kwargs)["rows"]
 
     def _delve_(self, _type, style, **kwargs):
         keys = kwargs.pop("keys", ("hydration", "results"))
@@ -99,34 +322,83 @@ class MixerService(object):
                 results = row
                 for k in keys:
                     results = results.get(k, {})
-                return (result["id"] for result in results)
+                return list(results)
         return []
 
     def _top_streams_(self, **kwargs):
-        return self.query(self._urls_["top_streams"], **kwargs)
+        return self.query(self._urls_["top_streams"], cache=True, **kwargs)
 
-    def _get_channels_(self, **kwargs):
+    def _channels_query_(self, **kwargs):
+        kwargs.setdefault("cache", True)
         kwargs.setdefault("page", 0)
         kwargs.setdefault("order", self._default_order_)
-        return self.query(self._urls_["channels"], **kwargs)
+        return self._urls_["channels"], kwargs
+
+    def _index_channels_(self, results, kwargs):
+        if "fields" not in kwargs: # don't index partial objects
+            results = _observed_(results, self.channel_index.update)
+        return results
+
+    def _get_channels_(self, **kwargs):
+        url, kwargs = self._channels_query_(**kwargs)
+        return self._index_channels_(self.query(url, **kwargs), kwargs)
+
+    # one query per chunk of ids, concurrent if possible (see query_all)
+    def _get_channels_in_(self, ids, **kwargs):
+        queries = [self._channels_query_(where=self._where_id_in_(chunk),
+                                         limit=len(chunk), **kwargs)
+                   for chunk in self._chunks_(ids)]
+        return list(chain.from_iterable(
+            self._index_channels_(results, kwargs)
+            for results, (_, kwargs) in zip(self.query_all(queries), queries)))
+
+    # extra: fields needed on top of _channel_fields_ (e.g. for sorting)
+    def _hydrate_channels_(self, results, key=None, reverse=False, extra=()):
+        # delve rows are (at least partially) hydrated, only query the channels
+        # that miss something, and only what they miss
+        results = list(results)
+        required = self._channel_fields_ + tuple(extra)
+        missing = {}
+        for result in results:
+            for field in chain(required, self._channel_objects_):
+                if field not in result:
+                    missing.setdefault(result["id"], set()).add(field)
+        if missing:
+            fields = set(chain.from_iterable(missing.values()))
+            kwargs = {}
+            # partial nested objects are not an option, fetch everything
+            if fields.isdisjoint(self._channel_objects_):
+                kwargs["fields"] = ",".join(sorted(fields | {"id"}))
+            hydrated = {result["id"]: result
+                        for result in self._get_channels_in_(missing, **kwargs)}
+            for result in results:
+                result.update(hydrated.get(result["id"], {}))
+            # not returned (deleted, suspended since), nothing to show
+            results = [result for result in results
+                       if all(field in result for field in required)]
+        self.channel_index.update(results)
+        if key:
+            results.sort(key=key, reverse=reverse)
+        return results
 
     def _get_channel_(self, id, **kwargs):
         return self.query(self._urls_["channel"].format(id), **kwargs)
 
-    def _get_vods_(self, id, **kwargs):
-        return self.query(self._urls_["vods"].format(id), **kwargs)
-
     def _get_vod_(self, id, **kwargs):
         return self.query(self._urls_["vod"].format(id), **kwargs)
 
     def _get_games_(self, **kwargs):
         kwargs["noCount"] = "true"
+        kwargs.setdefault("cache", True)
         kwargs.setdefault("page", 0)
         kwargs.setdefault("order", self._default_order_)
-        return self.query(self._urls_["games"], **kwargs)
+        return _observed_(self.query(self._urls_["games"], **kwargs),
+                          self.game_index.update)
 
     def _get_game_(self, id, **kwargs):
-        return self.query(self._urls_["game"].format(id))
+        result = self.query(self._urls_["game"].format(id))
+        self.game_index.update((result,))
+        return result
 
     # see objects.Vod ----------------------------------------------------------
 
@@ -134,21 +406,43 @@ class MixerService(object):
         return objects.Games(self._get_games_(limit=limit, **kwargs),
                              limit=limit)
 
-    def games(self, **kwargs):
-        games = self._games_(**kwargs)
-        self.game_cache.update(games)
-        return games
+    def _cache_games_(self, results):
+        self.game_cache.update(objects.Games(results))
+
+    def games(self, limit=0, **kwargs):
+        return objects.Games(
+            _observed_(self._get_games_(limit=limit, **kwargs),
+                       self._cache_games_),
+            limit=limit)
 
     def _game_(self, id):
         game = objects.GameType(self._get_game_(id))
         self.game_cache[id] = game
         return game
 
+    # fetch all game types once, rather than one request per missing type
+    def _warm_games_(self):
+        if not self.games_warm:
+            try:
+                self.game_cache.update(self._games_())
+            except requests.RequestException as error:
+                warn("failed to fetch game types: {}".format(error))
+            else:
+                self.games_warm = True
+
     def game(self, id):
         try:
             return self.game_cache[id]
         except KeyError:
-            return self._game_(id)
+            game = self.store.game(id)
+            if game:
+                game = self.game_cache[id] = objects.GameType(game)
+                return game
+            self._warm_games_()
+            try:
+                return self.game_cache[id]
+            except KeyError:
+                return self._game_(id)
 
     # --------------------------------------------------------------------------
 
@@ -157,77 +451,138 @@ class MixerService(object):
 
     def featured(self, **kwargs):
         results = self._delve_("carousel", "", keys=("channels",), **kwargs)
-        if results:
-            results = self._get_channels_(where=self._where_id_in_(results))
-        return objects.Streams(results)
+        return objects.Streams(
+            self._hydrate_channels_(results, key=_viewers_, reverse=True))
 
     def spotlight(self, **kwargs):
         results = self._delve_("channels", "onlyOnMixer", **kwargs)
-        if results:
-            results = self._get_channels_(where=self._where_id_in_(results))
-        return objects.Channels(results)
+        return objects.Channels(
+            self._hydrate_channels_(results, key=_viewers_, reverse=True))
 
     def top_games(self, **kwargs):
         results = self._delve_("games", "", **kwargs)
         if results:
-            return self.games(where=self._where_id_in_(results))
-        return objects.Games(results, limit=limit)
+            where = self._where_id_in_((result["id"] for result in results))
+            return self.games(where=where)
+        return objects.Games(results)
 
     def up_and_coming(self, **kwargs):
         results = self._delve_("channels", "upAndComing", **kwargs)
-        if results:
-            where = self._where_id_in_(results)
-            order = "online:DESC,createdAt:DESC"
-            results = self._get_channels_(where=where, order=order)
-        return objects.Streams(results)
+        return objects.Streams(
+            self._hydrate_channels_(
+                results, key=lambda x: (x["online"], x["createdAt"]),
+                reverse=True, extra=("createdAt",)))
 
     def top_streams(self, **kwargs):
         results = self._top_streams_(**kwargs)
-        if results:
-            where = self._where_id_in_((result["id"] for result in results))
-            results = self._get_channels_(where=where)
-        return objects.TopStreams(results)
+        return objects.TopStreams(
+            self._hydrate_channels_(results, key=_viewers_, reverse=True))
+
+    # --------------------------------------------------------------------------
+
+    def favorites(self, ids, **kwargs):
+        order = "online:DESC,viewersCurrent:DESC,token:ASC"
+        ids = list(ids)
+        try:
+            results = self._get_channels_in_(ids, order=order)
+        except requests.RequestException as error:
+            # show them as last seen rather than nothing
+            warn("failed to fetch favorites: {}".format(error))
+            return objects.FavoriteChannels(self.store.channels(ids))
+        # each chunk is already ordered, only merge when there is more than one
+        if len(ids) > self._chunk_size_:
+            results = sorted(
+                results, key=lambda x: (not x["online"], -x["viewersCurrent"],
+                                        x["token"]))
+        return objects.FavoriteChannels(results)
+
+    # used by the service, only fetch what is needed to detect transitions
+    def online(self, ids):
+        return self._get_channels_in_(ids, fields="id,token,online",
+                                      cache=False)
 
     # --------------------------------------------------------------------------
 
+    # lets the caller (see Dispatcher.addItems) fetch the next page later
+    def _paged_(self, items, func, *args, **kwargs):
+        kwargs["page"] = int(kwargs.get("page", 0)) + 1
+        items.next = lambda: func(*args, **kwargs)
+        return items
+
     def browse_channels(self, limit=0, **kwargs):
-        return objects.Channels(
-            self._get_channels_(limit=limit, **kwargs), limit=limit)
+        return self._paged_(
+            objects.Channels(
+                self._get_channels_(limit=limit, stream=True, **kwargs),
+                limit=limit),
+            self.browse_channels, limit=limit, **kwargs)
 
     def browse_channel(self, **kwargs):
         id = kwargs.pop("id")
-        stream = objects.Stream(self._get_channel_(id, **kwargs))
-        return (stream, objects.Vods(self._get_vods_(id, **kwargs),
-                                     category=stream.token))
+        channel, vods = self.query_all(
+            ((self._urls_["channel"].format(id), kwargs),
+             (self._urls_["vods"].format(id),
+              dict(kwargs, cache=True, stream=True))))
+        stream = objects.Stream(channel)
+        return (stream, objects.Vods(vods, category=stream.token))
 
     def browse_games(self, **kwargs):
-        return self.games(**kwargs)
+        return self._paged_(
+            self.games(stream=True, **kwargs), self.browse_games, **kwargs)
 
     def browse_game(self, limit=0, **kwargs):
         id = kwargs.pop("id")
         where = "typeId:eq:{}".format(id)
-        return objects.Streams(
-            self._get_channels_(where=where, limit=limit, **kwargs),
-            limit=limit, category=self.game(id).name)
+        try:
+            results = self._get_channels_(where=where, limit=limit, stream=True,
+                                          **kwargs)
+        except requests.RequestException as error:
+            # online channels for that game, as last seen
+            warn("failed to fetch channels: {}".format(error))
+            return objects.Streams(self.store.game_channels(id),
+                                   category=self.game(id).name)
+        return self._paged_(
+            objects.Streams(results, limit=limit, category=self.game(id).name),
+            self.browse_game, id=id, limit=limit, **kwargs)
 
     # --------------------------------------------------------------------------
 
-    def search_channels(self, query, limit=0, **kwargs):
+    def _search_(self, index, query, fetch, limit=0, page=0, predicate=None):
+        # local matches come first, remote results only fill past them
+        local = (limit or self._chunk_size_) * self._local_pages_
+        results = self.search_cache.results(
+            (index.key, query.lower(), limit),
+            lambda: SearchResults(index.search(query, predicate, local)))
+        return results.slice(int(page), limit, fetch)
+
+    def search_channels(self, query, limit=0, page=0, **kwargs):
         where = "suspended:eq:false,vodsEnabled:eq:true"
         order = "viewersCurrent:DESC,viewersTotal:DESC,token:ASC"
         scope = "names"
-        return objects.Channels(
-            self._get_channels_(where=where, order=order, scope=scope,
-                                q=query, limit=limit, **kwargs),
-            limit=limit)
-
-    def search_games(self, query, limit=0, **kwargs):
-        results = self._get_games_(query=query, limit=limit, **kwargs)
-        if results:
-            where = self._where_id_in_((result["id"] for result in results))
-            order = "viewersCurrent:DESC,name:ASC"
-            return self.games(where=where, order=order, limit=limit)
-        return objects.Games(results, limit=limit)
+        def fetch(**_kwargs):
+            return self._get_channels_(where=where, order=order, scope=scope,
+                                       q=query, **dict(kwargs, **_kwargs))
+        def predicate(item):
+            return not item.get("suspended") and item.get("vodsEnabled")
+        results, more = self._search_(
+            self.channel_index, query, fetch, limit, page, predicate)
+        channels = objects.Channels(results)
+        channels.more = more
+        return self._paged_(channels, self.search_channels, query,
+                            limit=limit, page=page, **kwargs)
+
+    def search_games(self, query, limit=0, page=0, **kwargs):
+        order = "viewersCurrent:DESC,name:ASC"
+        def fetch(**_kwargs):
+            results = self._get_games_(query=query, order=order,
+                                       **dict(kwargs, **_kwargs))
+            self._cache_games_(results)
+            return results
+        results, more = self._search_(
+            self.game_index, query, fetch, limit, page)
+        games = objects.Games(results)
+        games.more = more
+        return self._paged_(games, self.search_games, query,
+                            limit=limit, page=page, **kwargs)
 
 
 service = MixerService()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+
+from __future__ import absolute_import, division, unicode_literals
+
+
+from collections import OrderedDict
+from sys import getsizeof
+from threading import Lock
+from time import time
+
+from six import iteritems
+
+
+# approximate (deep) size of decoded json
+def sizeof(value):
+    size = getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sizeof(k) + sizeof(v) for k, v in iteritems(value))
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(sizeof(v) for v in value)
+    return size
+
+
+class CacheStats(object):
+
+    _repr_ = ("entries: {0.entries}/{0.size}, hits: {0.hits}, "
+              "misses: {0.misses} ({0.ratio:.0%} hits), "
+              "evictions: {0.evictions}, expired: {0.expired}, "
+              "memory: {0.kib:.1f}KiB")
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.memory = 0 # bytes, as measured when the entries were stored
+
+    def __repr__(self):
+        return self._repr_.format(self)
+
+    @property
+    def entries(self):
+        return len(self.cache)
+
+    @property
+    def size(self):
+        return self.cache.size
+
+    @property
+    def ratio(self):
+        return self.hits / ((self.hits + self.misses) or 1)
+
+    @property
+    def kib(self):
+        return self.memory / 1024
+
+
+# bounded, least recently used entries go first, entries older than ttl
+# (if any) are dropped when looked up
+class LRUCache(object):
+
+    def __init__(self, size=32, ttl=0):
+        self.__entries__ = OrderedDict()
+        self.size = size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.stats = CacheStats(self)
+
+    def __len__(self):
+        return len(self.__entries__)
+
+    def __contains__(self, key):
+        return self._key_(key) in self.__entries__
+
+    def _key_(self, key):
+        return key
+
+    def _sizeof_(self, value):
+        return sizeof(value)
+
+    def _evict_(self):
+        while len(self.__entries__) > self.size:
+            _, (_, size, _) = self.__entries__.popitem(last=False)
+            self.stats.evictions += 1
+            self.stats.memory -= size
+
+    def lookup(self, key, ttl=None):
+        key = self._key_(key)
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            try:
+                timestamp, size, value = self.__entries__.pop(key)
+            except KeyError:
+                self.stats.misses += 1
+                raise
+            if ttl and (time() - timestamp) > ttl:
+                self.stats.expired += 1
+                self.stats.misses += 1
+                self.stats.memory -= size
+                raise KeyError(key)
+            self.__entries__[key] = (timestamp, size, value) # most recent last
+            self.stats.hits += 1
+            return value
+
+    def store(self, key, value):
+        key = self._key_(key)
+        size = self._sizeof_(value)
+        with self.lock:
+            previous = self.__entries__.pop(key, None)
+            if previous:
+                self.stats.memory -= previous[1]
+            self.__entries__[key] = (time(), size, value)
+            self.stats.memory += size
+            self._evict_()
+
+    def discard(self, key):
+        with self.lock:
+            previous = self.__entries__.pop(self._key_(key), None)
+            if previous:
+                self.stats.memory -= previous[1]
+
+    def resize(self, size):
+        with self.lock:
+            self.size = size
+            self._evict_()
+
+
+# decoded responses of list endpoints, so that re-sorting/filtering a listing
+# doesn't hit the network
+class ResponseCache(LRUCache):
+
+    def get(self, key, ttl):
+        try:
+            return self.lookup(key, ttl)
+        except KeyError:
+            return None
+
+    def set(self, key, value):
+        self.store(key, value)
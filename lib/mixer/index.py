@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+
+from __future__ import absolute_import, division, unicode_literals
+
+
+from .cache import LRUCache, sizeof
+
+
+# ------------------------------------------------------------------------------
+# local index
+# ------------------------------------------------------------------------------
+
+# everything seen is kept in the store (see store.Store.search)
+class Index(object):
+
+    def __init__(self, store, table, key):
+        self.store = store
+        self.table = table
+        self.key = key
+
+    def update(self, items):
+        getattr(self.store, "update_{}".format(self.table))(items)
+
+    def search(self, query, predicate=None, limit=100):
+        return [item for item in
+                self.store.search(self.table, self.key, query, limit)
+                if predicate is None or predicate(item)]
+
+
+# ------------------------------------------------------------------------------
+# recent searches
+# ------------------------------------------------------------------------------
+
+class SearchResults(object):
+
+    def __init__(self, items):
+        self.items = list(items)
+        self.ids = {item["id"] for item in self.items}
+        self.page = 0 # next remote page
+        self.done = False
+
+    def extend(self, items, limit):
+        self.page += 1
+        self.done = len(items) < limit
+        for item in items:
+            if item["id"] not in self.ids:
+                self.ids.add(item["id"])
+                self.items.append(item)
+
+    def slice(self, page, limit, fetch):
+        start, end = page * limit, (page + 1) * limit
+        while len(self.items) < end and not self.done:
+            self.extend(fetch(page=self.page, limit=limit), limit)
+        return (self.items[start:end],
+                (len(self.items) > end) or not self.done)
+
+
+class SearchCache(LRUCache):
+
+    def __init__(self, size=16, ttl=300):
+        super(SearchCache, self).__init__(size, ttl)
+
+    # results grow as more pages are fetched, only the first is accounted for
+    def _sizeof_(self, results):
+        return sizeof(results.items)
+
+    def results(self, key, factory):
+        try:
+            return self.lookup(key)
+        except KeyError:
+            results = factory()
+            self.store(key, results)
+            return results
@@ -6,47 +6,88 @@ from __future__ import absolute_import, division, unicode_literals
 
 import sys
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from uuid import UUID
 from itertools import chain
 
 from six import string_types, iteritems, with_metaclass, raise_from
+from kodi_six import xbmcplugin
 
 from .. import _folders_schema_, _folders_defaults_
-from ..utils import ListItem, build_url, localized_string
+from ..utils import ListItem, build_url, localized_string, context_menu
+from ..artwork import artwork
+from .cache import LRUCache, sizeof
 
 
 # ------------------------------------------------------------------------------
 # cache
 # ------------------------------------------------------------------------------
 
-class Cache(dict):
+class Cache(LRUCache):
 
-    def __init__(self, items=None):
-        if not items:
-            items = []
-        super(Cache, self).__init__({int(item.id): item for item in items})
+    def __init__(self, items=None, size=500, ttl=0):
+        super(Cache, self).__init__(size, ttl)
+        if items:
+            self.update(items)
+
+    def _key_(self, key):
+        return int(key)
+
+    def _sizeof_(self, item):
+        return sizeof(item.__data__)
 
     def __getitem__(self, key):
-        return super(Cache, self).__getitem__(int(key))
+        return self.lookup(key)
 
     def __setitem__(self, key, value):
-        return super(Cache, self).__setitem__(int(key), value)
+        self.store(key, value)
 
     def __delitem__(self, key):
-        return super(Cache, self).__delitem__(int(key))
+        self.discard(key)
 
+    # items come most relevant first, keep those the longest
     def update(self, items):
-        return super(Cache, self).update({int(item.id): item for item in items})
+        for item in reversed(list(items)):
+            self.store(item.id, item)
 
 
 # ------------------------------------------------------------------------------
 # base types
 # ------------------------------------------------------------------------------
 
+_iso8601_separators_ = ("-", "-", "T", ":", ":")
+
+# fixed format parser for 'YYYY-MM-DDTHH:MM:SS[.ffffff][Z|(+|-)HH[:MM]]',
+# returns a naive (utc) datetime
+def _iso8601_(value):
+    separators = (value[4], value[7], value[10], value[13], value[16])
+    if separators != _iso8601_separators_:
+        raise ValueError("invalid ISO 8601 timestamp: {}".format(value))
+    result = datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                      int(value[11:13]), int(value[14:16]), int(value[17:19]))
+    i = 19
+    if value[i:i + 1] == ".":
+        j = i + 1
+        while j < len(value) and value[j].isdigit():
+            j += 1
+        microsecond = int(value[i + 1:j][:6].ljust(6, "0"))
+        result = result.replace(microsecond=microsecond)
+        i = j
+    offset = value[i:]
+    if offset and offset != "Z":
+        digits = offset[1:].replace(":", "")
+        if offset[0] not in "+-" or len(digits) not in (2, 4):
+            raise ValueError("invalid ISO 8601 timestamp: {}".format(value))
+        delta = timedelta(hours=int(digits[:2]), minutes=int(digits[2:] or 0))
+        result = (result - delta) if offset[0] == "+" else (result + delta)
+    return result
+
 def _date_(value):
     if isinstance(value, string_types):
-        return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+        try:
+            return _iso8601_(value)
+        except (IndexError, ValueError):
+            return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
     return value
 
 def _uuid_(value):
@@ -54,9 +95,14 @@ def _uuid_(value):
         return UUID(value)
     return value
 
+# converted values are memoized on the object
 def _json_(name, func):
     def getter(obj):
-        return func(obj.__getattr__(name))
+        try:
+            return obj.__cache__[name]
+        except KeyError:
+            value = obj.__cache__[name] = func(obj.__getattr__(name))
+            return value
     return property(getter)
 
 
@@ -78,7 +124,7 @@ class MixerType(type):
 
 class MixerObject(with_metaclass(MixerType, object)):
 
-    __slots__ = {"__data__"}
+    __slots__ = {"__data__", "__cache__"}
 
     def __new__(cls, data):
         if isinstance(data, dict):
@@ -89,6 +135,7 @@ class MixerObject(with_metaclass(MixerType, object)):
 
     def __init__(self, data):
         self.__data__ = data
+        self.__cache__ = {}
 
     def __getitem__(self, name):
         return self.__data__[name]
@@ -110,23 +157,101 @@ class MixerObject(with_metaclass(MixerType, object)):
     # XXX: not happy about plot() being here :(, but don't care enough to find
     # a better solution just right now
     def plot(self):
-        return self._plot_.format(self)
+        return localized_string(self._plot_).format(self)
+
+    # remote art urls by role, see artwork.Artwork
+    def art(self):
+        return {}
+
+
+# local sorting/filtering (see MixerItems.select), values come from the url
+
+def _get_(item, name, default=None):
+    try:
+        return item[name]
+    except KeyError:
+        return default
+
+def _name_(item):
+    return (_get_(item, "token") or _get_(item, "name") or
+            _get_(item, "title") or "").lower()
+
+_sort_keys_ = {
+    "viewers": (lambda x: _get_(x, "viewersCurrent", 0), True),
+    "followers": (lambda x: _get_(x, "numFollowers", 0), True),
+    "name": (_name_, False),
+    "language": (lambda x: _get_(x, "languageId") or "", False)
+}
 
+_filters_ = {
+    "audience": lambda x, value: _get_(x, "audience") == value,
+    "languageId": lambda x, value: _get_(x, "languageId") == value,
+    "online": lambda x, value: bool(_get_(x, "online")) == (value == "true"),
+    "typeId": lambda x, value: str(_get_(x, "typeId")) == value
+}
 
-class MixerItems(list):
+
+# objects (and their ListItem) are only built when iterated, items can be a
+# list or a generator (streamed response)
+class MixerItems(object):
 
     _ctor_ = MixerObject
     _content_ = "videos"
     _category_ = None
+    _sort_methods_ = ()
 
     def __init__(self, items, limit=0, content=None, category=None):
-        super(MixerItems, self).__init__((self._ctor_(item) for item in items))
-        self.more = (len(self) >= limit) if limit else False
+        self.__items__ = items
+        self.limit = limit
+        self.count = 0
         self.content = content or self._content_
         self.category = category or self._category_
+        self.sortMethods = self._sort_methods_
+        self.__more__ = None
+        self.next = None # returns the next page, see MixerService._paged_
+
+    def __len__(self):
+        return len(self.__items__)
+
+    def __iter__(self):
+        self.count = 0
+        for item in self.__items__:
+            self.count += 1
+            yield self._ctor_(item)
+
+    @property
+    def sized(self):
+        return hasattr(self.__items__, "__len__")
+
+    # when streaming this is only an estimate (assume a full page)
+    @property
+    def total(self):
+        if self.sized:
+            return len(self) + int(self.more)
+        return (self.limit + 1) if self.limit else 0
 
-    def items(self, *args):
-        return (item.item(*args) for item in self if item)
+    # when streaming this is only valid once all items have been consumed
+    @property
+    def more(self):
+        if self.__more__ is None:
+            if self.limit:
+                return (len(self) if self.sized else self.count) >= self.limit
+            return False
+        return self.__more__
+
+    @more.setter
+    def more(self, value):
+        self.__more__ = value
+
+    def select(self, sort=None, **filters):
+        filters = [(_filters_[name], value)
+                   for name, value in iteritems(filters) if name in _filters_]
+        items = (item for item in self
+                 if item and all(func(item, value) for func, value in filters))
+        if sort in _sort_keys_:
+            key, reverse = _sort_keys_[sort]
+            items = sorted(items, key=key, reverse=reverse)
+        return items
 
 
 # ------------------------------------------------------------------------------
@@ -160,15 +285,29 @@ class Folder(MixerObject):
             return ""
 
     def item(self, url):
-        folder = _folders_schema_[self.type][self.style]
-        label = localized_string(folder["id"])
-        action = folder.get("action", self.type)
-        plot = folder.get("plot", "")
-        if isinstance(plot, int):
-            plot = localized_string(plot)
+        label, action, infos = _folder_(self.type, self.style)
         return ListItem(
-            label, build_url(url, action=action), isFolder=True,
-            infos={"video": {"title": label, "plot": plot}})
+            label, build_url(url, action=action), isFolder=True, infos=infos)
+
+
+# static folder metadata, built once per language
+_folders_ = {}
+
+def _folder_(_type, style):
+    try:
+        folders = _folders_[localized_string.language]
+    except KeyError:
+        folders = _folders_[localized_string.language] = {}
+        for folder_type, styles in iteritems(_folders_schema_):
+            for folder_style, folder in iteritems(styles):
+                label = localized_string(folder["id"])
+                plot = folder.get("plot", "")
+                if isinstance(plot, int):
+                    plot = localized_string(plot)
+                folders[(folder_type, folder_style)] = (
+                    label, folder.get("action", folder_type),
+                    {"video": {"title": label, "plot": plot}})
+    return folders[(_type, style)]
 
 
 # games ------------------------------------------------------------------------
@@ -182,7 +321,7 @@ class GameTypeSimple(MixerObject):
 # https://dev.mixer.com/rest/index.html#GameType
 class GameType(GameTypeSimple):
 
-    _plot_ = localized_string(30053)
+    _plot_ = 30053
 
     @property
     def description(self):
@@ -205,12 +344,14 @@ class GameType(GameTypeSimple):
         except KeyError:
             return 0
 
+    def art(self):
+        return {"fanart": self.backgroundUrl, "poster": self.coverUrl}
+
     def item(self, url, action):
         return ListItem(
             self.name, build_url(url, action=action, id=self.id), isFolder=True,
             infos={"video": {"plot": self.plot()}},
-            fanart=self.backgroundUrl,
-            poster=self.coverUrl)
+            **artwork.paths(self.art()))
 
 
 _empty_game_ = GameType({"id": -1, "name": "", "backgroundUrl": "", "coverUrl": ""})
@@ -242,8 +383,9 @@ class ExtendedChannel(Channel):
 
     __json__ = {"user": User}
     _audience_ = {"family": 30050, "teen": 30051, "18+": 30052}
-    _plot_ = localized_string(30054)
-    _online_plot_ = localized_string(30055)
+    _plot_ = 30054
+    _online_plot_ = 30055
+    _favorite_menu_ = (30060, "add_favorite")
 
     @property
     def thumbnail(self):
@@ -257,17 +399,39 @@ class ExtendedChannel(Channel):
     def audience(self):
         return localized_string(self._audience_.get(self["audience"], 30052))
 
+    @property
+    def viewers(self):
+        return _get_(self, "viewersCurrent", 0) or 0
+
     def plot(self):
         if self.online:
-            return self._online_plot_.format(self)
+            return localized_string(self._online_plot_).format(self)
         return super(ExtendedChannel, self).plot()
 
+    def contextMenus(self, url):
+        label, action = self._favorite_menu_
+        return [context_menu(label, url, action=action, id=self.id),
+                context_menu(30065, url, action="sort_filter",
+                             languageId=_get_(self, "languageId") or "",
+                             typeId=_get_(self, "typeId") or "",
+                             audience=_get_(self, "audience") or "")]
+
+    def art(self):
+        return {"fanart": self.bannerUrl, "poster": self.user.avatarUrl}
+
     def item(self, url, action):
         return ListItem(
             self.token, build_url(url, action=action, id=self.id), isFolder=True,
-            infos={"video": {"plot": self.plot()}},
-            fanart=self.bannerUrl,
-            poster=self.user.avatarUrl)
+            infos={"video": {"plot": self.plot(),
+                             "country": _get_(self, "languageId") or "",
+                             "count": self.viewers}},
+            contextMenus=self.contextMenus(url),
+            **artwork.paths(self.art()))
+
+
+class FavoriteChannel(ExtendedChannel):
+
+    _favorite_menu_ = (30061, "remove_favorite")
 
 
 # streams ----------------------------------------------------------------------
@@ -277,18 +441,24 @@ class Stream(ExtendedChannel):
     _repr_ = "Stream({0.id}, token={0.token})"
     _video_infos_ = {"mediatype": "video", "playcount": 0}
 
-    def _item(self, path):
+    def art(self):
+        return {"fanart": self.bannerUrl, "thumb": self.thumbnail.url}
+
+    def _item(self, path, contextMenus=None):
         if self.online:
             title = " - ".join((self.token, self.name))
             return ListItem(
                 title, path,
                 infos={"video": dict(self._video_infos_,
-                                     title=title, plot=self.plot())},
-                fanart=self.bannerUrl,
-                thumb=self.thumbnail.url)
+                                     title=title, plot=self.plot(),
+                                     country=_get_(self, "languageId") or "",
+                                     count=self.viewers)},
+                contextMenus=contextMenus,
+                **artwork.paths(self.art()))
 
     def item(self, url, action):
-        return self._item(build_url(url, action=action, id=self.id))
+        return self._item(build_url(url, action=action, id=self.id),
+                          self.contextMenus(url))
 
 
 # vods -------------------------------------------------------------------------
@@ -297,7 +467,7 @@ class Locators(object):
 
     def __new__(cls, locators):
         if locators:
-            return super(Locators, cls).__new__(cls, locators)
+            return super(Locators, cls).__new__(cls)
         return None
 
     def __init__(self, locators):
@@ -312,7 +482,7 @@ class Vod(MixerObject):
     __uuid__ = {"contentId"}
     _repr_ = "Vod({0.id})"
     _video_infos_ = {"mediatype": "video"}
-    _plot_ = localized_string(30057)
+    _plot_ = 30057
 
     @property
     def type(self):
@@ -335,21 +505,30 @@ class Vod(MixerObject):
                 return getattr(locators, "ahls", None)
             return getattr(locators, "smoothstreaming", None)
 
+    def art(self):
+        locators = self.contentLocators
+        if locators:
+            thumbnail_large = getattr(locators, "thumbnail_large", "")
+            #thumbnail_small = getattr(locators, "thumbnail_small", "")
+            return {"fanart": thumbnail_large, "thumb": thumbnail_large}
+        return {}
+
     def _item(self, path):
         locators = self.contentLocators
         if locators:
             streamInfos = {"video": {"width": self.width,
                                      "height": self.height,
                                      "duration": self.durationInSeconds}}
-            thumbnail_large = getattr(locators, "thumbnail_large", "")
-            #thumbnail_small = getattr(locators, "thumbnail_small", "")
+            date = self.uploadDate
             return ListItem(
                 self.title, path,
                 infos={"video": dict(self._video_infos_,
-                                     title=self.title, plot=self.plot())},
+                                     title=self.title, plot=self.plot(),
+                                     date=date.strftime("%d.%m.%Y")
+                                     if date else "",
+                                     duration=self.durationInSeconds)},
                 streamInfos=streamInfos,
-                fanart=thumbnail_large,
-                thumb=thumbnail_large)
+                **artwork.paths(self.art()))
 
     def item(self, url, action):
         return self._item(build_url(url, action=action, id=self.id))
@@ -367,22 +546,41 @@ class Folders(MixerItems):
 class Home(Folders):
 
     def __init__(self, folders):
-        super(Home, self).__init__(chain(folders, _folders_defaults_))
+        super(Home, self).__init__(list(chain(folders, _folders_defaults_)))
+
+
+_channel_sort_methods_ = (
+    xbmcplugin.SORT_METHOD_UNSORTED,
+    xbmcplugin.SORT_METHOD_LABEL_IGNORE_THE,
+    xbmcplugin.SORT_METHOD_COUNTRY, # languageId
+    xbmcplugin.SORT_METHOD_PROGRAM_COUNT # viewersCurrent
+)
 
 
 class Channels(MixerItems):
 
     _ctor_ = ExtendedChannel
+    _sort_methods_ = _channel_sort_methods_
+
+
+class FavoriteChannels(Channels):
+
+    _ctor_ = FavoriteChannel
 
 
 class Games(MixerItems):
 
     _ctor_ = GameType
+    _sort_methods_ = (
+        xbmcplugin.SORT_METHOD_UNSORTED,
+        xbmcplugin.SORT_METHOD_LABEL_IGNORE_THE
+    )
 
 
 class Streams(MixerItems):
 
     _ctor_ = Stream
+    _sort_methods_ = _channel_sort_methods_
 
 
 class TopStreams(Streams):
@@ -395,4 +593,10 @@ class TopStreams(Streams):
 class Vods(MixerItems):
 
     _ctor_ = Vod
+    _sort_methods_ = (
+        xbmcplugin.SORT_METHOD_UNSORTED,
+        xbmcplugin.SORT_METHOD_LABEL_IGNORE_THE,
+        xbmcplugin.SORT_METHOD_DATE,
+        xbmcplugin.SORT_METHOD_DURATION
+    )
 
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+
+from __future__ import absolute_import, division, unicode_literals
+
+
+import json
+import sqlite3
+
+from errno import EEXIST, ENOENT
+from os import makedirs, remove
+from os.path import dirname
+from threading import local
+from time import time
+
+from ..utils import warn
+
+
+# upper bound for prefix ranges
+_last_ = "\uffff"
+
+
+# one connection per thread, the database is shared with other invocations and
+# the service (hence WAL)
+class Store(object):
+
+    _version_ = 2
+
+    # channels/games not seen for that long are dropped, checked once a day
+    _max_age_ = 30 * 24 * 3600
+    _prune_interval_ = 24 * 3600
+
+    _schema_ = (
+        # name/token are lowercased, for search
+        """CREATE TABLE IF NOT EXISTS games (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            viewersCurrent INTEGER NOT NULL DEFAULT 0,
+            data TEXT NOT NULL,
+            updated REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS games_name ON games (name)",
+        "CREATE INDEX IF NOT EXISTS games_updated ON games (updated)",
+        """CREATE TABLE IF NOT EXISTS channels (
+            id INTEGER PRIMARY KEY,
+            token TEXT NOT NULL,
+            typeId INTEGER,
+            online INTEGER NOT NULL DEFAULT 0,
+            viewersCurrent INTEGER NOT NULL DEFAULT 0,
+            data TEXT NOT NULL,
+            updated REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS channels_token ON channels (token)",
+        """CREATE INDEX IF NOT EXISTS channels_typeId
+            ON channels (typeId, online)""",
+        "CREATE INDEX IF NOT EXISTS channels_online ON channels (online)",
+        "CREATE INDEX IF NOT EXISTS channels_updated ON channels (updated)",
+        """CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS responses_updated ON responses (updated)"
+    )
+
+    _tables_ = ("games", "channels", "responses")
+
+    def __init__(self, path):
+        self.path = path
+        self.local = local()
+        self.pruned = 0
+
+    def _version_of_(self, connection):
+        return connection.execute("PRAGMA user_version").fetchone()[0]
+
+    def _migrate_(self, connection):
+        # other invocations may be opening the db at the same time, only one
+        # of them gets to (re)create the schema
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if self._version_of_(connection) != self._version_:
+                # everything in here can be fetched again
+                for table in self._tables_:
+                    connection.execute("DROP TABLE IF EXISTS {}".format(table))
+                for statement in self._schema_:
+                    connection.execute(statement)
+                connection.execute(
+                    "PRAGMA user_version = {}".format(self._version_))
+        except Exception:
+            connection.rollback()
+            raise
+        else:
+            connection.commit()
+
+    def _connect_(self):
+        try:
+            makedirs(dirname(self.path))
+        except OSError as error:
+            if error.errno != EEXIST:
+                raise
+        try:
+            return self._open_()
+        except sqlite3.OperationalError: # locked, busy, ... not corrupt
+            raise
+        except sqlite3.DatabaseError as error:
+            # everything in here can be fetched again, start over
+            warn("recreating '{}': {}".format(self.path, error))
+            self._remove_()
+            return self._open_()
+
+    def _open_(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            if self._version_of_(connection) != self._version_:
+                self._migrate_(connection)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def _remove_(self):
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                remove(self.path + suffix)
+            except OSError as error:
+                if error.errno != ENOENT:
+                    raise
+
+    def _prune_(self, connection):
+        now = time()
+        if (now - self.pruned) > self._prune_interval_:
+            self.pruned = now
+            with connection:
+                for table in ("games", "channels"):
+                    connection.execute(
+                        "DELETE FROM {} WHERE updated < ?".format(table),
+                        (now - self._max_age_,))
+
+    @property
+    def connection(self):
+        try:
+            return self.local.connection
+        except AttributeError:
+            connection = self.local.connection = self._connect_()
+            self._prune_(connection)
+            return connection
+
+    # the store is a best effort cache, failing to use it is not an error
+
+    def _select_(self, sql, *args):
+        try:
+            return [json.loads(row[0])
+                    for row in self.connection.execute(sql, args)]
+        except sqlite3.Error as error:
+            warn("failed to read from '{}': {}".format(self.path, error))
+            return []
+
+    def _write_(self, sql, rows, *statements):
+        try:
+            with self.connection as connection:
+                for statement, args in statements:
+                    connection.execute(statement, args)
+                connection.executemany(sql, rows)
+        except sqlite3.Error as error:
+            warn("failed to write to '{}': {}".format(self.path, error))
+
+    # games --------------------------------------------------------------------
+
+    def update_games(self, items):
+        now = time()
+        self._write_(
+            "INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?)",
+            [(item["id"], item["name"].lower(),
+              item.get("viewersCurrent") or 0, json.dumps(item), now)
+             for item in items if "id" in item and item.get("name")])
+
+    # most viewed first, see objects.Cache.update()
+    def games(self, ttl):
+        return self._select_(
+            "SELECT data FROM games WHERE updated > ? "
+            "ORDER BY viewersCurrent DESC", time() - ttl)
+
+    def game(self, id):
+        results = self._select_("SELECT data FROM games WHERE id = ?", int(id))
+        return results[0] if results else None
+
+    # channels -----------------------------------------------------------------
+
+    def update_channels(self, items):
+        now = time()
+        self._write_(
+            "INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(item["id"], item["token"].lower(), item.get("typeId"),
+              int(bool(item.get("online"))), item.get("viewersCurrent") or 0,
+              json.dumps(item), now)
+             for item in items if "id" in item and item.get("token")])
+
+    def channels(self, ids):
+        ids = [int(id) for id in ids]
+        if not ids:
+            return []
+        return self._select_(
+            "SELECT data FROM channels WHERE id IN ({}) "
+            "ORDER BY online DESC, viewersCurrent DESC".format(
+                ",".join("?" * len(ids))), *ids)
+
+    def game_channels(self, typeId):
+        return self._select_(
+            "SELECT data FROM channels WHERE typeId = ? AND online = 1 "
+            "ORDER BY viewersCurrent DESC", int(typeId))
+
+    # search -------------------------------------------------------------------
+
+    # table is 'games' or 'channels', column 'name' or 'token'
+    def search(self, table, column, query, limit=100):
+        query = query.lower()
+        like = "".join(("%", query.replace("\\", "\\\\").replace(
+            "%", "\\%").replace("_", "\\_"), "%"))
+        # prefix matches (range on the index) first, then substring matches
+        sql = ("SELECT data FROM {0} WHERE {1} >= ? AND {1} < ? "
+               "ORDER BY viewersCurrent DESC LIMIT ?").format(table, column)
+        results = self._select_(sql, query, query + _last_, limit)
+        if len(results) < limit:
+            sql = ("SELECT data FROM {0} WHERE {1} LIKE ? ESCAPE '\\' "
+                   "AND NOT ({1} >= ? AND {1} < ?) "
+                   "ORDER BY viewersCurrent DESC LIMIT ?").format(table, column)
+            results.extend(self._select_(
+                sql, like, query, query + _last_, limit - len(results)))
+        return results
+
+    # responses ----------------------------------------------------------------
+
+    def response(self, key, ttl):
+        results = self._select_(
+            "SELECT data FROM responses WHERE key = ? AND updated > ?",
+            key, time() - ttl)
+        return results[0] if results else None
+
+    def update_response(self, key, value, ttl):
+        now = time()
+        self._write_(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+            [(key, json.dumps(value), now)],
+            ("DELETE FROM responses WHERE updated < ?", (now - ttl,)))
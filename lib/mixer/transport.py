@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+
+from __future__ import absolute_import, division, unicode_literals
+
+
+import re
+
+from collections import deque
+from itertools import chain
+from json import JSONDecoder
+from threading import Lock, local
+from time import time
+
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.parse import urlparse
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+from requests.packages.urllib3.connectionpool import HTTPSConnectionPool
+
+
+# ------------------------------------------------------------------------------
+# stats
+# ------------------------------------------------------------------------------
+
+class TransportStats(object):
+
+    _repr_ = ("requests: {0.requests}, connections: {0.connections} "
+              "(reused: {0.reused}), connect time: {0.connect_time:.3f}s, "
+              "hedged: {0.hedged} (won: {0.hedges_won})")
+
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0 # connections handed out by the pool already open
+        self.connect_time = 0.0 # tcp connect + tls handshake
+        self.hedged = 0
+        self.hedges_won = 0
+
+    def __repr__(self):
+        return self._repr_.format(self)
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+
+    def connected(self, elapsed):
+        with self.lock:
+            self.connections += 1
+            self.connect_time += elapsed
+
+    def reuse(self):
+        with self.lock:
+            self.reused += 1
+
+    def hedge(self, won=False):
+        with self.lock:
+            if won:
+                self.hedges_won += 1
+            else:
+                self.hedged += 1
+
+
+# ------------------------------------------------------------------------------
+# latencies
+# ------------------------------------------------------------------------------
+
+_ids_ = re.compile(r"\d+")
+
+
+# 'https://mixer.com/api/v1/channels/123' -> '/api/v1/channels/{}'
+def endpoint(url):
+    return _ids_.sub("{}", urlparse(url).path)
+
+
+class LatencyTracker(object):
+
+    def __init__(self, size=100):
+        self.lock = Lock()
+        self.size = size
+        self.samples = {}
+
+    def add(self, endpoint, elapsed):
+        with self.lock:
+            try:
+                samples = self.samples[endpoint]
+            except KeyError:
+                samples = self.samples[endpoint] = deque(maxlen=self.size)
+            samples.append(elapsed)
+
+    def percentile(self, endpoint, percent, default=None, minimum=10):
+        with self.lock:
+            samples = sorted(self.samples.get(endpoint, ()))
+        if len(samples) < minimum:
+            return default
+        return samples[min(len(samples) - 1, len(samples) * percent // 100)]
+
+
+# per thread (i.e. per invocation) latency budget, see MixerSession.budget
+class Policy(local):
+
+    deadline = None
+    hedge = False
+
+
+def _pool_class_(pool_class, stats):
+
+    class Connection(pool_class.ConnectionCls):
+
+        def connect(self):
+            start = time()
+            super(Connection, self).connect()
+            stats.connected(time() - start)
+
+    # dropped connections are closed by the pool before they are handed out,
+    # an open socket here is an actual reuse
+    def _get_conn(self, *args, **kwargs):
+        connection = pool_class._get_conn(self, *args, **kwargs)
+        if getattr(connection, "sock", None) is not None:
+            stats.reuse()
+        return connection
+
+    return type(str("Counted{}".format(pool_class.__name__)), (pool_class,),
+                {"ConnectionCls": Connection, "_get_conn": _get_conn})
+
+
+# ------------------------------------------------------------------------------
+# adapter
+# ------------------------------------------------------------------------------
+
+class MixerAdapter(HTTPAdapter):
+
+    def __init__(self, pool_size=10, **kwargs):
+        self.stats = TransportStats()
+        super(MixerAdapter, self).__init__(
+            pool_connections=pool_size, pool_maxsize=pool_size, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(MixerAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _pool_class_(HTTPConnectionPool, self.stats),
+            "https": _pool_class_(HTTPSConnectionPool, self.stats)
+        }
+
+    def send(self, *args, **kwargs):
+        self.stats.request()
+        return super(MixerAdapter, self).send(*args, **kwargs)
+
+
+# ------------------------------------------------------------------------------
+# streaming
+# ------------------------------------------------------------------------------
+
+_skip_ = re.compile(r"[\s,]*").match
+_separators_ = frozenset(" \t\n\r,]")
+
+
+def iter_array(chunks):
+    """yield the elements of a JSON array as soon as they are complete"""
+    decoder = JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ""
+    started = False
+    for chunk in chain(chunks, (None,)):
+        eof = chunk is None
+        if not eof:
+            buffer += chunk
+        pos = _skip_(buffer, 0).end()
+        if not started:
+            if pos == len(buffer):
+                continue
+            if buffer[pos] != "[":
+                raise ValueError("expected a JSON array")
+            pos, started = _skip_(buffer, pos + 1).end(), True
+        while pos < len(buffer):
+            if buffer[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break # incomplete, wait for more
+            # numbers/literals may be truncated ('-1500.' of '-1500.0'), a
+            # value is only complete once followed by a separator
+            if not eof and (end == len(buffer) or
+                            buffer[end] not in _separators_):
+                break
+            yield item
+            pos = _skip_(buffer, end).end()
+        buffer = buffer[pos:]
+    raise ValueError("unexpected end of JSON array")
+
+
+def iter_response(response, chunk_size=16384):
+    try:
+        if not response.encoding:
+            response.encoding = "utf-8"
+        for item in iter_array(
+            response.iter_content(chunk_size, decode_unicode=True)):
+            yield item
+    finally:
+        response.close()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+
+from __future__ import absolute_import, division, unicode_literals
+
+
+from six import iteritems
+from kodi_six import xbmc, xbmcgui
+
+from .utils import SettingsMonitor, settings, get_language, localized_string
+from .utils import notify, debug, warn
+from .favorites import favorites
+from .mixer.api import service
+
+
+class FavoritesMonitor(SettingsMonitor):
+
+    # the interval doubles every time nothing changed, up to this factor
+    _backoff_ = 8
+    # how often to check if playback stopped (seconds)
+    _playing_interval_ = 30
+
+    _live_ = 30064
+
+    def __init__(self):
+        super(FavoritesMonitor, self).__init__()
+        self.player = xbmc.Player()
+        self.online = None
+        self.reset()
+
+    def reset(self):
+        self.enabled = settings.favorites_notify
+        self.base = settings.favorites_interval * 60
+        self.interval = self.base
+
+    def onSettingsChanged(self):
+        super(FavoritesMonitor, self).onSettingsChanged()
+        self.reset()
+
+    # --------------------------------------------------------------------------
+
+    def notify(self, channel):
+        notify(localized_string(self._live_).format(channel["token"]),
+               icon=xbmcgui.NOTIFICATION_INFO, time=5000)
+
+    def poll(self):
+        online = {channel["id"]: channel
+                  for channel in service.online(favorites.ids())}
+        known = self.online or {}
+        # only channels we saw offline on the previous poll are notified
+        changed = [channel for id, channel in iteritems(online)
+                   if id not in known or
+                   channel["online"] != known[id]["online"]]
+        for channel in changed:
+            if channel["online"] and channel["id"] in known:
+                self.notify(channel)
+        self.online = online
+        return bool(changed) or len(online) != len(known)
+
+    def tick(self):
+        try:
+            empty = not len(favorites)
+        except Exception as error:
+            # favorites.json being rewritten by an invocation, try again later
+            warn("failed to read favorites: {}".format(error))
+            return self.interval
+        if not self.enabled or empty:
+            self.online = None
+            return self.base
+        if self.player.isPlaying():
+            return self._playing_interval_
+        get_language()
+        try:
+            changed = self.poll()
+        except Exception as error:
+            warn("failed to poll favorites: {}".format(error))
+            changed = False
+        if changed:
+            self.interval = self.base
+        else:
+            self.interval = min(self.interval * 2, self.base * self._backoff_)
+        debug("next favorites poll in {}s".format(self.interval))
+        return self.interval
+
+    def run(self):
+        while not self.waitForAbort(self.tick()):
+            pass
+
+
+def run():
+    FavoritesMonitor().run()
@@ -4,7 +4,8 @@
 from __future__ import absolute_import, division, unicode_literals
 
 
-from os.path import join
+from itertools import islice
+from os.path import exists, getmtime, join
 
 from six import text_type, iteritems
 from six.moves.urllib.parse import parse_qsl, urlencode
@@ -15,6 +16,7 @@ from . import _subfolders_defaults_
 
 addon = xbmcaddon.Addon()
 addon_path = xbmc.translatePath(addon.getAddonInfo("path"))
+addon_profile = xbmc.translatePath(addon.getAddonInfo("profile"))
 
 dialog = xbmcgui.Dialog()
 
@@ -31,10 +33,38 @@ def build_url(*args, **kwargs):
     return "?".join(("/".join(args), urlencode(params)))
 
 
-def localized_string(id):
-    if id < 30000:
-        return xbmc.getLocalizedString(id)
-    return addon.getLocalizedString(id)
+# strings are memoized per language, see get_language()
+class LocalizedStrings(object):
+
+    def __init__(self):
+        self.language = None
+        self.languages = {}
+        self.strings = {}
+
+    def __call__(self, id):
+        try:
+            return self.strings[id]
+        except KeyError:
+            if id < 30000:
+                value = xbmc.getLocalizedString(id)
+            else:
+                value = addon.getLocalizedString(id)
+            self.strings[id] = value
+            return value
+
+    def update(self, language):
+        if language != self.language:
+            self.language = language
+            self.strings = self.languages.setdefault(language, {})
+
+
+localized_string = LocalizedStrings()
+
+
+def get_language():
+    language = xbmc.getLanguage(xbmc.ISO_639_1, True)
+    localized_string.update(language)
+    return language
 
 
 def get_media_path(*args):
@@ -44,17 +74,29 @@ def get_icon(name):
     return get_media_path("{}.png".format(name))
 
 
+def get_profile_path(*args):
+    return join(addon_profile, *args)
+
+
 def get_subfolders(style, subfolders=_subfolders_defaults_):
     return [{"type": folder, "style": style} for folder in subfolders]
 
 
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
 # settings ---------------------------------------------------------------------
 
 _get_settings_ = {
     bool: "getSettingBool",
     int: "getSettingInt",
     float: "getSettingNumber",
-    unicode: "getSettingString"
+    text_type: "getSettingString"
 }
 
 def get_setting(id, _type=None):
@@ -63,6 +105,53 @@ def get_setting(id, _type=None):
     return addon.getSetting(id)
 
 
+# snapshot of the settings, read once and reloaded when they change
+class Settings(object):
+
+    _settings_ = {
+        "items_per_page": int,
+        "pool_size": int,
+        "artwork_cache": bool,
+        "artwork_cache_size": int,
+        "cache_ttl": int,
+        "hedge_requests": bool,
+        "game_cache_size": int,
+        "response_cache_size": int,
+        "search_cache_size": int,
+        "stream_quality": int,
+        "vod_quality": int,
+        "favorites_notify": bool,
+        "favorites_interval": int
+    }
+
+    _path_ = get_profile_path("settings.xml")
+
+    def __init__(self):
+        self.reload()
+
+    def _mtime_(self):
+        return getmtime(self._path_) if exists(self._path_) else None
+
+    def reload(self):
+        self.mtime = self._mtime_()
+        for id, _type in iteritems(self._settings_):
+            setattr(self, id, get_setting(id, _type))
+
+    # cheap safety net for when onSettingsChanged could not be delivered
+    def refresh(self):
+        if self._mtime_() != self.mtime:
+            self.reload()
+
+
+settings = Settings()
+
+
+class SettingsMonitor(xbmc.Monitor):
+
+    def onSettingsChanged(self):
+        settings.reload()
+
+
 # logging ----------------------------------------------------------------------
 
 def log(msg, level=xbmc.LOGNOTICE):
@@ -87,7 +176,7 @@ class ListItem(xbmcgui.ListItem):
             offscreen=True)
 
     def __init__(self, label, path, isFolder=False, infos=None,
-                 streamInfos=None, **art):
+                 streamInfos=None, contextMenus=None, **art):
         self.setIsFolder(isFolder)
         self.setIsPlayable(not isFolder)
         self.isFolder = isFolder
@@ -97,6 +186,8 @@ class ListItem(xbmcgui.ListItem):
         if streamInfos:
             for info in iteritems(streamInfos):
                 self.addStreamInfo(*info)
+        if contextMenus:
+            self.addContextMenuItems(contextMenus)
         if art:
             self.setArt(art)
 
@@ -107,13 +198,21 @@ class ListItem(xbmcgui.ListItem):
         return self.getPath(), self, self.isFolder
 
 
-_more_label_ = localized_string(30099)
+def context_menu(label, url, **kwargs):
+    return (localized_string(label),
+            "RunPlugin({})".format(build_url(url, **kwargs)))
+
+
 _more_icon_ = get_icon("more")
 
 def more_item(url, **kwargs):
-    return ListItem(
-        _more_label_,  build_url(url, **kwargs), isFolder=True,
-        infos={"video": {"plot": _more_label_}}, icon=_more_icon_)
+    label = localized_string(30099)
+    item = ListItem(
+        label,  build_url(url, **kwargs), isFolder=True,
+        infos={"video": {"plot": label}}, icon=_more_icon_)
+    # stays last whatever the sort method picked in the ui
+    item.setProperty("SpecialSort", "bottom")
+    return item
 
 
 # quality ----------------------------------------------------------------------
@@ -136,7 +235,8 @@ class Quality(object):
     @classmethod
     def select(cls, qualities):
         return dialog.select(
-            cls._heading_, [str(quality) for quality in qualities])
+            localized_string(cls._heading_),
+            [str(quality) for quality in qualities])
 
     @classmethod
     def best_match(cls, quality, qualities):
@@ -154,29 +254,34 @@ class Quality(object):
 
 class StreamQuality(Quality):
 
-    _heading_ = localized_string(30102)
+    _heading_ = 30102
 
 
 class VodQuality(Quality):
 
-    _heading_ = localized_string(30112)
+    _heading_ = 30112
 
 
 # search -----------------------------------------------------------------------
 
-_search_label_ = localized_string(30002)
-
 def search_dialog():
-    return dialog.input(_search_label_)
+    return dialog.input(localized_string(30002))
 
 
-# notify -----------------------------------------------------------------------
+# select -----------------------------------------------------------------------
 
-_notify_heading_ = localized_string(30000)
+def select_dialog(heading, labels):
+    return dialog.select(localized_string(heading),
+                         [localized_string(label) for label in labels])
+
+
+# notify -----------------------------------------------------------------------
 
-def notify(message, heading=_notify_heading_, icon=xbmcgui.NOTIFICATION_ERROR,
+def notify(message, heading=30000, icon=xbmcgui.NOTIFICATION_ERROR,
            time=2000):
     if isinstance(message, int):
         message = localized_string(message)
+    if isinstance(heading, int):
+        heading = localized_string(heading)
     dialog.notification(heading, message, icon, time)
 
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+
+from __future__ import absolute_import, division, unicode_literals
+
+from lib.monitor import run
+
+
+if __name__ == "__main__":
+    run()
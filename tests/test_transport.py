@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+
+from __future__ import absolute_import, division, unicode_literals
+
+
+import json
+import unittest
+
+from lib.mixer.transport import iter_array
+
+
+# floats, exponents, negative numbers, literals, nested containers and strings
+# with separators in them, i.e. everything a split can land in
+_payload_ = json.dumps([
+    {"id": 1, "token": "a,b]c", "online": True, "viewersCurrent": -1500,
+     "durationInSeconds": 3600.25, "ratio": -1.5e-07, "big": 2E+10,
+     "user": {"avatarUrl": None, "tags": ["x", "y"]}},
+    -1500.0,
+    1e5,
+    False,
+    "é\\\"]",
+    [],
+    {},
+    {"nested": [[1, 2.5], {"a": [3]}]}
+], indent=1)
+
+
+def _chunks_(text, *offsets):
+    start = 0
+    for offset in offsets:
+        yield text[start:offset]
+        start = offset
+    yield text[start:]
+
+
+class IterArrayTest(unittest.TestCase):
+
+    def test_every_offset(self):
+        expected = json.loads(_payload_)
+        for offset in range(len(_payload_) + 1):
+            self.assertEqual(
+                list(iter_array(_chunks_(_payload_, offset))), expected,
+                "split at {}: {!r}".format(offset, _payload_[offset:][:10]))
+
+    def test_chunk_sizes(self):
+        expected = json.loads(_payload_)
+        for size in (1, 2, 3, 7, 19, 57, len(_payload_)):
+            chunks = [_payload_[i:i + size]
+                      for i in range(0, len(_payload_), size)]
+            self.assertEqual(list(iter_array(chunks)), expected, size)
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            list(iter_array(_chunks_(_payload_[:-5])))
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(iter_array(_chunks_('{"id": 1}')))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,620 @@
+# -*- coding: utf-8 -*-
+
+"""
+Concurrent invocations load test.
+
+Simulates a reused language invoker (i.e. one process, shared module state)
+serving many plugin invocations at once (e.g. skin widgets), against a local
+fake Mixer api, and reports throughput, latency percentiles, duplicate
+upstream requests and cache behaviour.
+
+Runs outside of Kodi (python 3), the xbmc* modules are replaced by minimal
+in-process fakes, the addon's own dependencies (requests, six, m3u8) have to
+be installed:
+
+    python tools/loadtest.py --invocations 500 --concurrency 16
+"""
+
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import types
+import xml.etree.ElementTree as ElementTree
+
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+
+_root_ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, len(values) * percent // 100)]
+
+
+# ------------------------------------------------------------------------------
+# fake mixer api
+# ------------------------------------------------------------------------------
+
+class FakeMixer(object):
+
+    _audiences_ = ("family", "teen", "18+")
+    _languages_ = ("en", "de", "fr", "es", "pt")
+
+    def __init__(self, channels=500, games=50, seed=0):
+        rnd = random.Random(seed)
+        self.base = ""
+        self.games = [
+            {"id": i, "name": "Game {}".format(i),
+             "description": "Game type #{}".format(i),
+             "viewersCurrent": rnd.randint(0, 50000),
+             "online": rnd.randint(0, 500),
+             "backgroundUrl": "/art/game/{}.background.jpg".format(i),
+             "coverUrl": "/art/game/{}.cover.jpg".format(i)}
+            for i in range(1, games + 1)]
+        self.channels = []
+        for i in range(1, channels + 1):
+            game = rnd.choice(self.games)
+            self.channels.append(
+                {"id": i, "token": "channel{}".format(i),
+                 "name": "Stream {}".format(i),
+                 "online": rnd.random() < 0.6,
+                 "viewersCurrent": rnd.randint(0, 10000),
+                 "viewersTotal": rnd.randint(0, 1000000),
+                 "numFollowers": rnd.randint(0, 100000),
+                 "audience": rnd.choice(self._audiences_),
+                 "languageId": rnd.choice(self._languages_),
+                 "suspended": False, "vodsEnabled": True,
+                 "typeId": game["id"], "type": game,
+                 "bannerUrl": "/art/channel/{}.banner.jpg".format(i),
+                 "thumbnail": {"id": i,
+                               "url": "/art/channel/{}.thumb.jpg".format(i)},
+                 "user": {"id": i, "username": "user{}".format(i),
+                          "avatarUrl": "/art/user/{}.avatar.jpg".format(i)},
+                 "createdAt": "2019-06-{:02d}T12:00:00.000Z".format(
+                     i % 28 + 1)})
+        self.channels_by_id = {c["id"]: c for c in self.channels}
+        self.games_by_id = {g["id"]: g for g in self.games}
+
+    # helpers ------------------------------------------------------------------
+
+    def _art_(self, value):
+        # art urls are relative until the server knows where it listens
+        if isinstance(value, dict):
+            return {k: self._art_(v) for k, v in value.items()}
+        if isinstance(value, str) and value.startswith("/art/"):
+            return self.base + value
+        return value
+
+    @staticmethod
+    def _where_(items, where):
+        for clause in where.split(","):
+            field, op, value = clause.split(":", 2)
+            if op == "eq":
+                items = [i for i in items
+                         if str(i.get(field)).lower() == value.lower()]
+            elif op == "in":
+                values = set(value.split(";"))
+                items = [i for i in items if str(i.get(field)) in values]
+        return items
+
+    @staticmethod
+    def _order_(items, order):
+        for clause in reversed(order.split(",")):
+            field, _, direction = clause.partition(":")
+            items = sorted(items, key=lambda i: i.get(field) or 0,
+                           reverse=(direction == "DESC"))
+        return items
+
+    def _list_(self, items, args, default_order):
+        if "where" in args:
+            items = self._where_(items, args["where"])
+        items = self._order_(items, args.get("order", default_order))
+        limit = int(args.get("limit") or 0) or 50
+        page = int(args.get("page") or 0)
+        items = items[page * limit:(page + 1) * limit]
+        if "fields" in args:
+            fields = args["fields"].split(",")
+            items = [{f: i[f] for f in fields if f in i} for i in items]
+        return [self._art_(item) for item in items]
+
+    # endpoints ----------------------------------------------------------------
+
+    def get_home(self, args):
+        online = [c for c in self.channels if c["online"]]
+        def partial(channels):
+            return [{"id": c["id"], "token": c["token"]} for c in channels]
+        rows = [
+            {"type": "carousel", "style": "", "channels": partial(online[:8])},
+            {"type": "channels", "style": "onlyOnMixer",
+             "hydration": {"results": partial(online[8:20])}},
+            {"type": "games", "style": "",
+             "hydration": {"results": [{"id": g["id"]}
+                                       for g in self.games[:12]]}},
+            {"type": "channels", "style": "upAndComing",
+             "hydration": {"results": [self._art_(c)
+                                       for c in online[20:32]]}}]
+        return {"rows": rows}
+
+    def get_top_streams(self, args):
+        online = [c for c in self.channels if c["online"]]
+        return self._list_(online, args, "viewersCurrent:DESC")
+
+    def get_channels(self, args):
+        items = self.channels
+        if "q" in args:
+            q = args["q"].lower()
+            items = [c for c in items if q in c["token"]]
+        return self._list_(items, args, "viewersCurrent:DESC")
+
+    def get_channel(self, args, id):
+        return self._art_(self.channels_by_id[int(id)])
+
+    def get_games(self, args):
+        items = self.games
+        if "query" in args:
+            q = args["query"].lower()
+            items = [g for g in items if q in g["name"].lower()]
+        return self._list_(items, args, "viewersCurrent:DESC")
+
+    def get_game(self, args, id):
+        return self._art_(self.games_by_id[int(id)])
+
+    def get_vods(self, args, id):
+        channel = self.channels_by_id[int(id)]
+        return [
+            {"shareableId": "{}-{}".format(id, i),
+             "title": "Vod {} of {}".format(i, channel["token"]),
+             "typeId": channel["typeId"], "viewCount": i * 10,
+             "uploadDate": "2019-07-{:02d}T20:00:00.000Z".format(i + 1),
+             "width": 1280, "height": 720, "durationInSeconds": 3600,
+             "contentLocators": [
+                 {"locatorType": "SmoothStreaming",
+                  "uri": self.base + "/vod/{}-{}/manifest".format(id, i)},
+                 {"locatorType": "Thumbnail_Large",
+                  "uri": self.base + "/art/vod/{}-{}.jpg".format(id, i)}]}
+            for i in range(5)]
+
+    _routes_ = (
+        (re.compile(r"^/api/v1/delve/home$"), "get_home"),
+        (re.compile(r"^/api/v1/delve/topStreams$"), "get_top_streams"),
+        (re.compile(r"^/api/v1/channels$"), "get_channels"),
+        (re.compile(r"^/api/v1/channels/(\d+)$"), "get_channel"),
+        (re.compile(r"^/api/v1/types$"), "get_games"),
+        (re.compile(r"^/api/v1/types/(\d+)$"), "get_game"),
+        (re.compile(r"^/api/v2/vods/channels/(\d+)$"), "get_vods")
+    )
+
+    def route(self, path, args):
+        for pattern, name in self._routes_:
+            match = pattern.match(path)
+            if match:
+                return json.dumps(getattr(self, name)(args, *match.groups()))
+        return None
+
+
+class FakeMixerServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, mixer, latency=0.02, tail=0.05, tail_factor=10):
+        super(FakeMixerServer, self).__init__(("127.0.0.1", 0), _Handler)
+        self.mixer = mixer
+        self.latency = latency
+        self.tail = tail
+        self.tail_factor = tail_factor
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.endpoints = Counter()
+        self.inflight = Counter()
+        self.overlapping = 0 # same request while an identical one was pending
+        self.url = "http://127.0.0.1:{}".format(self.server_address[1])
+        mixer.base = self.url
+
+    def delay(self):
+        delay = random.expovariate(1 / self.latency) if self.latency else 0
+        if random.random() < self.tail:
+            delay *= self.tail_factor
+        return delay
+
+    def begin(self, key, endpoint):
+        with self.lock:
+            self.requests[key] += 1
+            self.endpoints[endpoint] += 1
+            if self.inflight[key]:
+                self.overlapping += 1
+            self.inflight[key] += 1
+
+    def end(self, key):
+        with self.lock:
+            self.inflight[key] -= 1
+
+
+_ids_ = re.compile(r"\d+")
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def _send_(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        server = self.server
+        endpoint = _ids_.sub("{}", url.path)
+        server.begin(self.path, endpoint)
+        try:
+            time.sleep(server.delay())
+            if url.path.startswith("/art/"):
+                return self._send_(200, b"\xff\xd8\xff\xd9", "image/jpeg")
+            if url.path.endswith("/manifest.m3u8"):
+                return self._send_(
+                    200, b"#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1,"
+                    b"RESOLUTION=1280x720\nsource.m3u8\n",
+                    "application/vnd.apple.mpegurl")
+            body = server.mixer.route(url.path, dict(parse_qsl(url.query)))
+            if body is None:
+                return self._send_(404, b"[]", "application/json")
+            self._send_(200, body.encode("utf-8"), "application/json")
+        finally:
+            server.end(self.path)
+
+
+# ------------------------------------------------------------------------------
+# fake kodi
+# ------------------------------------------------------------------------------
+
+class _Noop(object):
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class FakeListItem(_Noop):
+
+    def __new__(cls, label="", path="", **kwargs):
+        self = super(FakeListItem, cls).__new__(cls)
+        self._path = path
+        return self
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def getPath(self):
+        return self._path
+
+
+class FakeDirectories(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = Counter()
+        self.results = {}
+
+    def add(self, handle, count):
+        with self.lock:
+            self.items[handle] += count
+        return True
+
+    def end(self, handle, success):
+        with self.lock:
+            self.results[handle] = success
+
+
+def _settings_(overrides):
+    tree = ElementTree.parse(os.path.join(_root_, "resources", "settings.xml"))
+    settings = {setting.get("id"): setting.get("default", "")
+                for setting in tree.iter("setting")}
+    settings.update(overrides)
+    return settings
+
+
+def _strings_():
+    path = os.path.join(_root_, "resources", "language",
+                        "resource.language.en_gb", "strings.po")
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+    return {int(id): json.loads('"{}"'.format(msgid))
+            for id, msgid in re.findall(
+                r'msgctxt "#(\d+)"\nmsgid "((?:[^"\\]|\\.)*)"', content)}
+
+
+def install_kodi(profile, settings, directories):
+    strings = _strings_()
+
+    class Addon(object):
+        def getAddonInfo(self, id):
+            return {"path": _root_, "profile": profile,
+                    "id": "plugin.video.mixer"}.get(id, "")
+        def getSetting(self, id):
+            return settings.get(id, "")
+        def getSettingBool(self, id):
+            return settings.get(id) == "true"
+        def getSettingInt(self, id):
+            return int(settings.get(id) or 0)
+        def getSettingNumber(self, id):
+            return float(settings.get(id) or 0)
+        def getSettingString(self, id):
+            return settings.get(id, "")
+        def getLocalizedString(self, id):
+            return strings.get(id, str(id))
+
+    class Monitor(object):
+        def abortRequested(self):
+            return False
+        def waitForAbort(self, timeout=None):
+            return True
+
+    class Player(object):
+        def isPlaying(self):
+            return False
+
+    class Dialog(_Noop):
+        def select(self, *args, **kwargs):
+            return -1
+        def input(self, *args, **kwargs):
+            return ""
+
+    xbmc = types.ModuleType(str("xbmc"))
+    xbmc.__dict__.update(
+        ISO_639_1=0, LOGDEBUG=0, LOGNOTICE=2, LOGWARNING=3, LOGERROR=4,
+        Monitor=Monitor, Player=Player, log=lambda *args, **kwargs: None,
+        translatePath=lambda path: path, getLanguage=lambda *args: "en",
+        getLocalizedString=lambda id: str(id),
+        getInfoLabel=lambda label: {"System.ScreenWidth": "1920"}.get(label, ""),
+        executebuiltin=lambda *args: None)
+    xbmcaddon = types.ModuleType(str("xbmcaddon"))
+    xbmcaddon.Addon = Addon
+    xbmcgui = types.ModuleType(str("xbmcgui"))
+    xbmcgui.__dict__.update(
+        ListItem=FakeListItem, Dialog=Dialog, NOTIFICATION_INFO="info",
+        NOTIFICATION_WARNING="warning", NOTIFICATION_ERROR="error")
+    xbmcplugin = types.ModuleType(str("xbmcplugin"))
+    xbmcplugin.__dict__.update(
+        {"SORT_METHOD_{}".format(name): i
+         for i, name in enumerate(("UNSORTED", "LABEL_IGNORE_THE", "COUNTRY",
+                                   "PROGRAM_COUNT", "DATE", "DURATION"))})
+    xbmcplugin.__dict__.update(
+        addDirectoryItem=lambda handle, *item: directories.add(handle, 1),
+        addDirectoryItems=lambda handle, items, total=0: directories.add(
+            handle, len(items)),
+        endOfDirectory=directories.end,
+        setResolvedUrl=lambda handle, success, item: directories.end(
+            handle, success),
+        setContent=lambda *args: None,
+        setPluginCategory=lambda *args: None,
+        addSortMethod=lambda *args: None)
+    xbmcvfs = types.ModuleType(str("xbmcvfs"))
+    kodi_six = types.ModuleType(str("kodi_six"))
+    kodi_six.__dict__.update(xbmc=xbmc, xbmcaddon=xbmcaddon, xbmcgui=xbmcgui,
+                             xbmcplugin=xbmcplugin, xbmcvfs=xbmcvfs)
+    inputstreamhelper = types.ModuleType(str("inputstreamhelper"))
+    inputstreamhelper.Helper = lambda *args: types.SimpleNamespace(
+        check_inputstream=lambda: True)
+    sys.modules.update(
+        xbmc=xbmc, xbmcaddon=xbmcaddon, xbmcgui=xbmcgui, xbmcplugin=xbmcplugin,
+        xbmcvfs=xbmcvfs, kodi_six=kodi_six,
+        inputstreamhelper=inputstreamhelper)
+
+
+# ------------------------------------------------------------------------------
+# load
+# ------------------------------------------------------------------------------
+
+class CacheProbe(object):
+
+    """Counts hits/misses of a get(key, ...) -> value or None method."""
+
+    def __init__(self, obj, name):
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.errors = Counter()
+        get = getattr(obj, name)
+        def probe(*args, **kwargs):
+            try:
+                value = get(*args, **kwargs)
+            except Exception as error: # shared state raced
+                with self.lock:
+                    self.errors[type(error).__name__] += 1
+                raise
+            with self.lock:
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return value
+        setattr(obj, name, probe)
+
+    def __str__(self):
+        total = (self.hits + self.misses) or 1
+        return "hits: {}, misses: {} ({:.1%} hit rate){}".format(
+            self.hits, self.misses, self.hits / total,
+            ", errors: {}".format(dict(self.errors)) if self.errors else "")
+
+
+def invocations(mixer, count, seed=0):
+    rnd = random.Random(seed)
+    online = [c["id"] for c in mixer.channels if c["online"]]
+    channels = [c["id"] for c in mixer.channels]
+    games = [g["id"] for g in mixer.games]
+    mix = (
+        (10, lambda: {"action": "home"}),
+        (8, lambda: {"action": "featured"}),
+        (6, lambda: {"action": "spotlight"}),
+        (6, lambda: {"action": "top_games"}),
+        (6, lambda: {"action": "up_and_coming"}),
+        (8, lambda: {"action": "top_streams"}),
+        (6, lambda: {"action": "favorites"}),
+        (6, lambda: {"action": "browse_channels",
+                     "page": str(rnd.randint(0, 3))}),
+        (6, lambda: {"action": "browse_games"}),
+        (8, lambda: {"action": "browse_game",
+                     "id": str(rnd.choice(games))}),
+        (8, lambda: {"action": "browse_channel",
+                     "id": str(rnd.choice(channels))}),
+        (4, lambda: {"action": "search_channels",
+                     "query": "channel{}".format(rnd.randint(1, 9))}),
+        (4, lambda: {"action": "search_games",
+                     "query": "game {}".format(rnd.randint(1, 5))}),
+        (8, lambda: {"action": "play_stream", "id": str(rnd.choice(online))}),
+    )
+    weights = [weight for weight, _ in mix]
+    for _ in range(count):
+        yield rnd.choices(mix, weights)[0][1]()
+
+
+def run(args):
+    profile = tempfile.mkdtemp(prefix="mixer-loadtest-")
+    try:
+        mixer = FakeMixer(channels=args.channels, games=args.games,
+                          seed=args.seed)
+        server = FakeMixerServer(mixer, latency=args.latency / 1000,
+                                 tail=args.tail)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        directories = FakeDirectories()
+        install_kodi(profile, _settings_(dict(args.setting)), directories)
+        sys.path.insert(0, _root_)
+
+        # warm start: game types already in the store (no request at import)
+        from lib.mixer.store import Store
+        Store(os.path.join(profile, "mixer.db")).update_games(
+            [mixer._art_(game) for game in mixer.games])
+        with open(os.path.join(profile, "favorites.json"), "w") as f:
+            json.dump(random.Random(args.seed).sample(
+                [c["id"] for c in mixer.channels], args.favorites), f)
+
+        from lib.dispatcher import dispatch
+        from lib.mixer.api import service
+        service._url_ = server.url + "/api/"
+        store = CacheProbe(service.store, "response")
+
+        lock = threading.Lock()
+        latencies = defaultdict(list)
+        errors = Counter()
+        queue = list(enumerate(invocations(mixer, args.invocations, args.seed),
+                               1))
+        queue.reverse()
+
+        def worker():
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    handle, query = queue.pop()
+                action = query["action"]
+                start = time.time()
+                try:
+                    dispatch("plugin://plugin.video.mixer/", str(handle),
+                             "?" + "&".join("{}={}".format(*item)
+                                            for item in query.items()))
+                except Exception as error:
+                    key = "{}: {!r}".format(action, error)
+                    with lock:
+                        first = key not in errors
+                        errors[key] += 1
+                    if first and args.traceback:
+                        traceback.print_exc()
+                finally:
+                    elapsed = time.time() - start
+                    with lock:
+                        latencies[action].append(elapsed)
+
+        start = time.time()
+        threads = [threading.Thread(target=worker)
+                   for _ in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.time() - start
+        server.shutdown()
+
+        report(args, wall, latencies, errors, server, directories,
+               store, service)
+    finally:
+        shutil.rmtree(profile, ignore_errors=True)
+
+
+def report(args, wall, latencies, errors, server, directories,
+           store, service):
+    every = [value for values in latencies.values() for value in values]
+    print("invocations: {} with {} concurrent, {:.2f}s ({:.1f}/s)".format(
+        len(every), args.concurrency, wall, len(every) / wall))
+    print("\n{:<18} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+        "action", "count", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for action, values in sorted(latencies.items()) + [("all", every)]:
+        print("{:<18} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            action, len(values), percentile(values, 50) * 1000,
+            percentile(values, 95) * 1000, percentile(values, 99) * 1000,
+            max(values) * 1000))
+    failed = sum(1 for success in directories.results.values()
+                 if not success)
+    print("\nfailed invocations: {}".format(failed))
+    for error, count in errors.most_common():
+        print("    {}: {}".format(error, count))
+
+    upstream = sum(server.requests.values())
+    duplicates = sum(count - 1 for count in server.requests.values())
+    print("\nupstream requests: {} ({} distinct, {} duplicates, "
+          "{} overlapping)".format(upstream, len(server.requests), duplicates,
+                                   server.overlapping))
+    for endpoint, count in server.endpoints.most_common():
+        print("    {:<36} {:>6}".format(endpoint, count))
+    print("\nduplicated the most:")
+    for key, count in server.requests.most_common(args.top):
+        if count > 1:
+            print("    {:>4} {}".format(count, key))
+    print()
+    for name, cache in service.caches():
+        print("{} cache: {}".format(name, cache.stats))
+    print("response cache (store): {}".format(store))
+    print("transport: {}".format(service.session.stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Concurrent invocations load test against a fake api")
+    parser.add_argument("-n", "--invocations", type=int, default=200)
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=20,
+                        help="mean api latency (ms)")
+    parser.add_argument("--tail", type=float, default=0.05,
+                        help="fraction of (10x) slow api responses")
+    parser.add_argument("--channels", type=int, default=500)
+    parser.add_argument("--games", type=int, default=50)
+    parser.add_argument("--favorites", type=int, default=150)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--top", type=int, default=10,
+                        help="how many duplicated requests to list")
+    parser.add_argument("--traceback", action="store_true",
+                        help="print the first traceback of each error")
+    parser.add_argument("--setting", action="append", default=[],
+                        type=lambda value: tuple(value.split("=", 1)),
+                        metavar="ID=VALUE", help="override an addon setting")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()